@@ -0,0 +1,538 @@
+import subprocess
+import threading
+import time
+from collections import deque
+from os import getenv
+from typing import IO, Callable, Deque, Optional, TypedDict
+
+from discord import AudioSource, FFmpegPCMAudio
+from discord.opus import Encoder as OpusEncoder
+
+from pata_logger import Logger
+
+logger = Logger("audio_sources")
+
+# 25 frames of 20ms, half a second of audio ready before the hand-off
+PRIME_FRAMES: int = 25
+# A next track that can't prime in time is dropped, it would hold an executor worker
+PRIME_TIMEOUT_SECONDS: float = float(getenv("PRIME_TIMEOUT_SECONDS", "20"))
+
+# Ring buffer capacity and how many frames must be buffered before (re)starting playback
+AUDIO_BUFFER_FRAMES: int = int(getenv("AUDIO_BUFFER_FRAMES", "150"))
+AUDIO_JITTER_FRAMES: int = int(getenv("AUDIO_JITTER_FRAMES", "25"))
+# How long the reader thread waits for FFmpeg to exit after its stdout closed
+FFMPEG_EXIT_TIMEOUT_SECONDS: float = 5.0
+
+FRAME_SIZE: int = OpusEncoder.FRAME_SIZE
+FRAME_SECONDS: float = OpusEncoder.FRAME_LENGTH / 1000
+SILENCE_FRAME: bytes = bytes(FRAME_SIZE)
+
+# EOF closer than this to the end of the track is treated as the track finishing
+RESUME_END_MARGIN_SECONDS: float = 3.0
+MAX_RESUMES: int = int(getenv("MAX_RESUMES", "3"))
+RECOVERY_TIMEOUT_SECONDS: float = float(getenv("RECOVERY_TIMEOUT_SECONDS", "30"))
+
+
+class AudioBufferStats(TypedDict):
+    frames: int
+    underruns: int
+    # times FFmpeg was ahead and waited for the player, normal back-pressure and not a fault
+    full_waits: int
+
+
+# Totals of every ring buffer source created since the bot started
+audio_buffer_totals: AudioBufferStats = AudioBufferStats(frames=0, underruns=0, full_waits=0)
+
+
+class PlaybackRecoveryStats(TypedDict):
+    resumes: int
+    failures: int
+    total_latency_ms: float
+    last_latency_ms: float
+
+
+playback_recovery_totals: PlaybackRecoveryStats = PlaybackRecoveryStats(
+    resumes=0, failures=0, total_latency_ms=0.0, last_latency_ms=0.0
+)
+
+
+class PreparedTrack:
+    def __init__(self, video_url: str, source: AudioSource) -> None:
+        self.video_url: str = video_url
+        self.source: AudioSource = source
+        self.primed: Deque[bytes] = deque()
+
+
+class GaplessAudioSource(AudioSource):
+    """
+    Wraps the audio source of the current track and holds the next one already spawned
+    and primed with buffered frames, when the current track hits EOF the switch happens
+    inside read() so the audio player never stops between songs.
+    """
+
+    def __init__(
+        self,
+        source: AudioSource,
+        video_url: str,
+        peek_next: Callable[[], str],
+        on_track_change: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.current: PreparedTrack = PreparedTrack(video_url, source)
+        self.pending: Optional[PreparedTrack] = None
+        # Returns the url that is next in the playlist right now, used to detect queue edits
+        self.peek_next: Callable[[], str] = peek_next
+        self.on_track_change: Optional[Callable[[str], None]] = on_track_change
+        # url being resolved and primed right now, avoids opening the same track twice
+        self.preparing_video_url: Optional[str] = None
+
+        self._lock: threading.Lock = threading.Lock()
+        self._skip_requested: bool = False
+        self._closed: bool = False
+
+    @property
+    def video_url(self) -> str:
+        return self.current.video_url
+
+    @property
+    def next_video_url(self) -> Optional[str]:
+        pending: PreparedTrack | None = self.pending
+        return pending.video_url if pending is not None else None
+
+    def prepare_next(self, video_url: str, source: AudioSource) -> bool:
+        """
+        primes the already spawned source of the next track, blocks until the frames
+        arrive so it must run outside the event loop. A stalled stream is cleaned up
+        after PRIME_TIMEOUT_SECONDS, which ends the blocked read() with an EOF.
+        """
+        track: PreparedTrack = PreparedTrack(video_url, source)
+        timed_out: threading.Event = threading.Event()
+
+        def give_up() -> None:
+            timed_out.set()
+            source.cleanup()
+
+        watchdog: threading.Timer = threading.Timer(PRIME_TIMEOUT_SECONDS, give_up)
+        watchdog.daemon = True
+        watchdog.start()
+
+        try:
+            for _ in range(PRIME_FRAMES):
+                frame: bytes = source.read()
+                if not frame:
+                    break
+                track.primed.append(bytes(frame))
+        finally:
+            watchdog.cancel()
+
+        if timed_out.is_set():
+            logger.error(
+                f"Next track did not prime within {PRIME_TIMEOUT_SECONDS}s: {video_url}"
+            )
+            return False
+
+        if not track.primed:
+            logger.error(f"Next track produced no audio: {video_url}")
+            source.cleanup()
+            return False
+
+        with self._lock:
+            if self._closed:
+                source.cleanup()
+                return False
+
+            old_pending: PreparedTrack | None = self.pending
+            self.pending = track
+
+        if old_pending is not None:
+            old_pending.source.cleanup()
+
+        logger.debug(f"Next track ready with {len(track.primed)} primed frames: {video_url}")
+
+        return True
+
+    def discard_next(self) -> None:
+        with self._lock:
+            pending: PreparedTrack | None = self.pending
+            self.pending = None
+
+        if pending is not None:
+            logger.debug(f"Discarding pre-opened track: {pending.video_url}")
+            pending.source.cleanup()
+
+    def skip(self) -> bool:
+        """switches to the pre-opened track on the next read, False if there is none to switch to"""
+        with self._lock:
+            pending: PreparedTrack | None = self.pending
+
+            if pending is None or pending.video_url != self.peek_next():
+                return False
+
+            self._skip_requested = True
+            return True
+
+    def _switch_to_pending(self) -> bool:
+        with self._lock:
+            pending: PreparedTrack | None = self.pending
+            self.pending = None
+            self._skip_requested = False
+
+        if pending is None:
+            return False
+
+        # the queue changed after the track was pre-opened, let the normal path take over
+        if pending.video_url != self.peek_next():
+            logger.debug(f"Queue changed, dropping pre-opened track: {pending.video_url}")
+            pending.source.cleanup()
+            return False
+
+        self.current.source.cleanup()
+        self.current = pending
+
+        if self.on_track_change is not None:
+            self.on_track_change(pending.video_url)
+
+        return True
+
+    def read(self) -> bytes:
+        if not self._skip_requested:
+            if self.current.primed:
+                return self.current.primed.popleft()
+
+            frame: bytes = self.current.source.read()
+            if frame:
+                return frame
+
+        if not self._switch_to_pending():
+            return b""
+
+        return self.current.primed.popleft()
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self._closed = True
+
+        self.discard_next()
+        self.current.source.cleanup()
+
+
+class RingBufferFFmpegAudio(FFmpegPCMAudio):
+    """
+    FFmpegPCMAudio that reads FFmpeg's stdout from its own thread into a pre-allocated ring
+    of frames. Playback only starts (or restarts after an underrun) once `jitter_frames` are
+    buffered, an empty buffer mid-stream hands out silence instead of stalling the audio thread.
+
+    With `zero_copy` the frames are handed out as memoryviews of the ring, discord.py's opus
+    encoder needs real bytes so it's only safe when wrapped by PCMVolumeTransformer, which
+    copies the frame through audioop before the next read() call releases the slot.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        *,
+        buffer_frames: int = AUDIO_BUFFER_FRAMES,
+        jitter_frames: int = AUDIO_JITTER_FRAMES,
+        zero_copy: bool = False,
+        **kwargs,
+    ) -> None:
+        self.buffer_frames: int = max(buffer_frames, 2)
+        self.jitter_frames: int = min(max(jitter_frames, 1), self.buffer_frames - 1)
+        self.zero_copy: bool = zero_copy
+        self.stats: AudioBufferStats = AudioBufferStats(frames=0, underruns=0, full_waits=0)
+
+        self._ring: bytearray = bytearray(self.buffer_frames * FRAME_SIZE)
+        self._ring_view: memoryview = memoryview(self._ring)
+        # monotonic frame counters, slot = counter % buffer_frames
+        self._written: int = 0
+        self._read: int = 0
+        self._holding_slot: bool = False
+        self._buffering: bool = True
+        self._started: bool = False
+        self._stats_reported: bool = False
+        self._eof: bool = False
+        # discord.py 2.6 FFmpegAudio has neither _stopped nor _check_process_returncode
+        self._stopped: bool = False
+        self.returncode: Optional[int] = None
+        self._condition: threading.Condition = threading.Condition()
+
+        # spawns FFmpeg, everything cleanup() touches has to exist before in case it fails
+        super().__init__(source, **kwargs)
+
+        self._reader_thread: threading.Thread = threading.Thread(
+            target=self._fill_ring,
+            args=(self._stdout,),
+            daemon=True,
+            name=f"ring-buffer-reader:pid-{self._process.pid}",
+        )
+        self._reader_thread.start()
+
+    def _fill_ring(self, stdout: IO[bytes]) -> None:
+        try:
+            while True:
+                with self._condition:
+                    # one slot stays reserved for the frame handed out to the player
+                    if self._written - self._read >= self.buffer_frames - 1:
+                        self.stats["full_waits"] += 1
+                    while (
+                        self._written - self._read >= self.buffer_frames - 1
+                        and not self._stopped
+                    ):
+                        self._condition.wait()
+
+                    if self._stopped:
+                        return
+
+                    offset: int = (self._written % self.buffer_frames) * FRAME_SIZE
+
+                slot: memoryview = self._ring_view[offset : offset + FRAME_SIZE]
+                filled: int = 0
+                while filled < FRAME_SIZE:
+                    received: int | None = stdout.readinto(slot[filled:])  # type: ignore
+                    if not received:
+                        return
+                    filled += received
+
+                with self._condition:
+                    self._written += 1
+                    self._condition.notify_all()
+        except (ValueError, OSError):
+            # the pipe was closed by cleanup()
+            return
+        finally:
+            returncode: int | None = None if self._stopped else self._wait_for_exit()
+
+            with self._condition:
+                self.returncode = returncode
+                self._eof = True
+                self._condition.notify_all()
+
+    def _wait_for_exit(self) -> Optional[int]:
+        """waits for FFmpeg after its stdout closed, off the audio thread"""
+        try:
+            returncode: int = self._process.wait(timeout=FFMPEG_EXIT_TIMEOUT_SECONDS)
+        except subprocess.TimeoutExpired:
+            return None
+
+        if returncode != 0:
+            logger.error(f"FFmpeg process {self._process.pid} exited with code {returncode}")
+
+        return returncode
+
+    @property
+    def failed(self) -> bool:
+        """True once the stream ended because FFmpeg exited with an error"""
+        return self._eof and self.returncode not in (None, 0)
+
+    def read(self) -> bytes:
+        with self._condition:
+            if self._holding_slot:
+                self._read += 1
+                self._holding_slot = False
+                self._condition.notify_all()
+
+            buffered: int = self._written - self._read
+
+            if self._buffering and buffered < self.jitter_frames and not self._eof:
+                if self._started:
+                    # refilling after an underrun, keep the player going with silence
+                    return SILENCE_FRAME
+
+                # only the start of the track blocks, same as a plain FFmpegPCMAudio
+                self._condition.wait_for(
+                    lambda: self._written - self._read >= self.jitter_frames
+                    or self._eof
+                )
+                buffered = self._written - self._read
+
+            self._buffering = False
+            self._started = True
+
+            if buffered == 0:
+                if self._eof:
+                    return b""
+
+                self.stats["underruns"] += 1
+                self._buffering = True
+                return SILENCE_FRAME
+
+            offset: int = (self._read % self.buffer_frames) * FRAME_SIZE
+            self.stats["frames"] += 1
+
+            if self.zero_copy:
+                self._holding_slot = True
+                return self._ring_view[offset : offset + FRAME_SIZE]  # type: ignore
+
+            self._read += 1
+            self._condition.notify_all()
+            return bytes(self._ring_view[offset : offset + FRAME_SIZE])
+
+    def cleanup(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+        super().cleanup()
+
+        # cleanup also runs from __del__, only report once
+        if self._stats_reported:
+            return
+        self._stats_reported = True
+
+        for key in audio_buffer_totals:
+            audio_buffer_totals[key] += self.stats[key]  # type: ignore
+
+        logger.debug(f"Ring buffer stats: {self.stats}")
+
+
+class ResumableAudioSource(AudioSource):
+    """
+    Tracks the playback position of a track and, when its source ends early or fails
+    (e.g. the googlevideo url expired), reopens it from a background thread at the saved
+    offset while handing out silence. `reopen` receives the offset in seconds and must
+    resolve a fresh stream url, it runs outside the event loop and the audio thread.
+    """
+
+    def __init__(
+        self,
+        source: AudioSource,
+        reopen: Callable[[float], Optional[AudioSource]],
+        duration: Optional[float] = None,
+        max_resumes: int = MAX_RESUMES,
+    ) -> None:
+        self.source: AudioSource = source
+        self.reopen: Callable[[float], Optional[AudioSource]] = reopen
+        self.duration: Optional[float] = duration
+        self.max_resumes: int = max_resumes
+        self.frames: int = 0
+        self.resumes: int = 0
+
+        self._lock: threading.Lock = threading.Lock()
+        self._recovery_thread: Optional[threading.Thread] = None
+        self._recovery_started: float = 0.0
+        self._recovered: Optional[AudioSource] = None
+        self._recovered_frame: bytes = b""
+        self._recovery_failed: bool = False
+        self._gave_up: bool = False
+        self._closed: bool = False
+
+    @property
+    def elapsed(self) -> float:
+        """seconds of the track already handed out, silence from underruns doesn't count"""
+        return self.frames * FRAME_SECONDS
+
+    def _is_early_eof(self) -> bool:
+        # e.g. FFmpeg giving up on an expired googlevideo url
+        if isinstance(self.source, RingBufferFFmpegAudio) and self.source.failed:
+            return True
+
+        if self.duration is None:
+            return False
+
+        return self.elapsed < self.duration - RESUME_END_MARGIN_SECONDS
+
+    def _recover(self, offset: float) -> None:
+        new_source: AudioSource | None = None
+        first_frame: bytes = b""
+
+        try:
+            new_source = self.reopen(offset)
+            if new_source is not None:
+                # wait for the first frame here, not in the audio thread
+                first_frame = new_source.read()
+        except Exception as e:
+            logger.error(f"Failed to reopen stream at {offset:.2f}s: {e}")
+
+        with self._lock:
+            if self._closed or new_source is None or not first_frame:
+                self._recovery_failed = True
+            else:
+                self._recovered = new_source
+                self._recovered_frame = first_frame
+                return
+
+        if new_source is not None:
+            new_source.cleanup()
+
+    def _start_recovery(self) -> None:
+        logger.warning(
+            f"Stream ended early at {self.elapsed:.2f}s of {self.duration}s, resuming"
+        )
+        self._recovery_started = time.perf_counter()
+        self._recovery_failed = False
+        self._recovery_thread = threading.Thread(
+            target=self._recover,
+            args=(self.elapsed,),
+            daemon=True,
+            name=f"stream-recovery:{id(self):#x}",
+        )
+        self._recovery_thread.start()
+
+    def _finish_recovery(self) -> bytes:
+        with self._lock:
+            recovered: AudioSource | None = self._recovered
+            first_frame: bytes = self._recovered_frame
+            failed: bool = self._recovery_failed
+            self._recovered = None
+            self._recovered_frame = b""
+
+        latency_ms: float = (time.perf_counter() - self._recovery_started) * 1000
+
+        if recovered is not None:
+            self.source.cleanup()
+            self.source = recovered
+            self.resumes += 1
+            self._recovery_thread = None
+
+            playback_recovery_totals["resumes"] += 1
+            playback_recovery_totals["total_latency_ms"] += latency_ms
+            playback_recovery_totals["last_latency_ms"] = latency_ms
+            logger.info(f"Resumed stream at {self.elapsed:.2f}s in {latency_ms:.0f}ms")
+
+            self.frames += 1
+            return first_frame
+
+        if failed or latency_ms > RECOVERY_TIMEOUT_SECONDS * 1000:
+            playback_recovery_totals["failures"] += 1
+            logger.error(f"Could not resume stream after {latency_ms:.0f}ms")
+            self._gave_up = True
+            return b""
+
+        return SILENCE_FRAME
+
+    def read(self) -> bytes:
+        if self._gave_up:
+            return b""
+
+        if self._recovery_thread is not None:
+            return self._finish_recovery()
+
+        frame: bytes = self.source.read()
+
+        if frame:
+            if frame is not SILENCE_FRAME:
+                self.frames += 1
+            return frame
+
+        if self.resumes >= self.max_resumes or not self._is_early_eof():
+            return b""
+
+        self._start_recovery()
+
+        return SILENCE_FRAME
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self) -> None:
+        with self._lock:
+            self._closed = True
+            recovered: AudioSource | None = self._recovered
+            self._recovered = None
+
+        if recovered is not None:
+            recovered.cleanup()
+
+        self.source.cleanup()
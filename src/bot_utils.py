@@ -1,9 +1,29 @@
-from asyncio import Event
+import asyncio
+from asyncio import AbstractEventLoop, Event
 import platform
-from typing import Any, Dict, Literal, Optional
+from functools import partial
+from typing import Any, Coroutine, Dict, Literal, Optional, Set
 from yt_dlp import YoutubeDL
 from pata_logger import Logger
 from playlist import PlayList
+from audio_sources import (
+    GaplessAudioSource,
+    PreparedTrack,
+    ResumableAudioSource,
+    RingBufferFFmpegAudio,
+)
+from message_dispatcher import (
+    NO_AUDIO_SOURCE_EMBED,
+    NO_STREAM_URL_EMBED,
+    MessageDispatcher,
+)
+from title_index import TitleIndex, TitleIndexMatch
+from local_library import (
+    LOCAL_TRACK_PREFIX,
+    LibraryTrack,
+    LocalLibrary,
+    local_track_path,
+)
 from os.path import exists
 from discord.utils import get
 from discord import (
@@ -13,11 +33,10 @@ from discord import (
     StageChannel,
     VoiceChannel,
     VoiceClient,
-    FFmpegPCMAudio,
     VoiceProtocol,
 )
 from discord.ext.commands import Bot, Context
-from youtube_result import YoutubeResult
+from youtube_result import YoutubeResult, YoutubeStream
 
 
 logger = Logger("bot_utils")
@@ -47,6 +66,16 @@ YOUTUBE_DLP_OPTIONS: Dict[str, Any] = {
     "max_sleep_interval": 90,
 }
 
+# The event loop only keeps weak references to tasks, keep fire and forget ones alive here
+background_tasks: Set[asyncio.Task] = set()
+
+
+def spawn_background_task(coroutine: Coroutine[Any, Any, Any]) -> asyncio.Task:
+    task: asyncio.Task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 
 def search_youtube(search_query: str, results: int = 5) -> Optional[YoutubeResult]:
     """obtains list of results from YouTube with best settings"""
@@ -79,8 +108,48 @@ def search_youtube(search_query: str, results: int = 5) -> Optional[YoutubeResul
         return None
 
 
+def resolve_query(
+    search_query: str,
+    guild_id: int,
+    title_index: TitleIndex,
+    local_library: Optional[LocalLibrary] = None,
+) -> Optional[YoutubeResult]:
+    """
+    matches the query against the local music library and then the title index,
+    only searching YouTube on a miss
+    """
+    if local_library is not None:
+        local_track: LibraryTrack | None = local_library.match(search_query)
+
+        if local_track is not None:
+            return YoutubeResult(
+                title=local_track["title"],
+                url_suffix=LOCAL_TRACK_PREFIX + local_track["path"],
+            )
+
+    index_match: TitleIndexMatch | None = title_index.match(search_query, guild_id)
+
+    if index_match is not None:
+        # fuzzy hits are not recorded as aliases, a wrong guess would become permanent
+        return index_match["result"]
+
+    result: YoutubeResult | None = search_youtube(search_query)
+
+    if result is not None:
+        title_index.record(guild_id, search_query, result)
+
+    return result
+
+
 def get_youtube_stream_url(video_url: str) -> Optional[str]:
     """Tries to obtain a stream url from a YouTube url"""
+    stream: YoutubeStream | None = get_youtube_stream_info(video_url)
+
+    return stream["url"] if stream is not None else None
+
+
+def get_youtube_stream_info(video_url: str) -> Optional[YoutubeStream]:
+    """Tries to obtain a stream url and the track duration from a YouTube url"""
     logger.debug(f"Extracting streamable url from: {video_url}")
 
     with YoutubeDL(YOUTUBE_DLP_OPTIONS) as ydl:  # type: ignore due to youtube-dlp lacking full type stubs
@@ -112,7 +181,9 @@ def get_youtube_stream_url(video_url: str) -> Optional[str]:
             logger.debug(f"Selected best audio format: {best_audio.get('format_id')}")
             logger.debug(f"Best audio URL: {best_audio['url']}")
 
-            return best_audio["url"]
+            return YoutubeStream(
+                url=best_audio["url"], duration=info_dict.get("duration")
+            )
 
         except Exception as e:
             logger.error(f"Failed to get stream URL: {e}")
@@ -120,12 +191,16 @@ def get_youtube_stream_url(video_url: str) -> Optional[str]:
 
 
 async def reproduce_song(
-    ctx: Context, video_url: str, bot: Bot, play_list: PlayList
+    ctx: Context,
+    video_url: str,
+    bot: Bot,
+    play_list: PlayList,
+    messenger: MessageDispatcher,
 ) -> None:
     try:
         if video_url is None:
             logger.error("Could not obtain audio source")
-            await ctx.send(f"Could not obtain audio source.")
+            await messenger.send_error(ctx, NO_AUDIO_SOURCE_EMBED)
             return
 
         if ctx.guild is None:
@@ -145,32 +220,55 @@ async def reproduce_song(
 
         if not voice_client.is_playing():
 
-            stream_url: str | None = get_youtube_stream_url(video_url)
+            local_path: str | None = local_track_path(video_url)
+            audio_source: PCMVolumeTransformer | None
 
-            if stream_url is None:
-                logger.error("Failed to retrieve stream URL.")
-                await ctx.send("Failed to retrieve stream URL.")
-                return
+            if local_path is not None:
+                audio_source = create_local_audio_source(local_path)
+            else:
+                stream: YoutubeStream | None = get_youtube_stream_info(video_url)
+
+                if stream is None:
+                    logger.error("Failed to retrieve stream URL.")
+                    await messenger.send_error(ctx, NO_STREAM_URL_EMBED)
+                    return
 
-            logger.debug(f"Converting url {stream_url} to audio source")
+                logger.debug(f"Converting url {stream['url']} to audio source")
 
-            audio_source = create_audio_source_from_url(stream_url)
+                audio_source = create_audio_source_from_url(
+                    stream["url"], video_url=video_url, duration=stream["duration"]
+                )
 
             if audio_source is None:
                 logger.error("Could not obtain audio source")
-                await ctx.send("Could not obtain audio source")
+                await messenger.send_error(ctx, NO_AUDIO_SOURCE_EMBED)
                 return
 
             finished_event: Event = Event()
+            loop: AbstractEventLoop = asyncio.get_running_loop()
 
             def after_playback(error: Exception | None):
                 if error:
                     logger.error(f"Playback error: {error}")
 
-                finished_event.set()
+                loop.call_soon_threadsafe(finished_event.set)
 
-            voice_client.play(audio_source, after=after_playback)
-            await ctx.send("Reproducing " + video_url)
+            def on_track_change(next_video_url: str) -> None:
+                # runs in the audio thread, hand the bookkeeping back to the event loop
+                loop.call_soon_threadsafe(
+                    handle_track_change, ctx, next_video_url, play_list, messenger
+                )
+
+            gapless_source: GaplessAudioSource = GaplessAudioSource(
+                audio_source,
+                video_url,
+                peek_next=lambda: play_list.peek_next_song(guild_id),
+                on_track_change=on_track_change,
+            )
+
+            voice_client.play(gapless_source, after=after_playback)
+            messenger.set_now_playing(ctx, "Reproducing " + video_url)
+            spawn_background_task(preload_next_song(gapless_source, play_list, guild_id))
             await finished_event.wait()
 
             if play_list.get_playlist_lenght(
@@ -186,19 +284,127 @@ async def reproduce_song(
                     logger.error("Could not obtain audio source")
                     return
 
-                await reproduce_song(ctx, actual_audio_name, bot, play_list)
+                await reproduce_song(
+                    ctx, actual_audio_name, bot, play_list, messenger
+                )
             else:
                 play_list.reset_play_list(guild_id)
+                await messenger.close(guild_id)
                 await voice_client.disconnect()
         else:
             play_list.add_to_playlist(guild_id, video_url)
-            await ctx.send("Added to playlist:  " + video_url)
+            messenger.set_event(ctx, "Added to playlist:  " + video_url)
+
+            if isinstance(voice_client.source, GaplessAudioSource):
+                spawn_background_task(
+                    preload_next_song(voice_client.source, play_list, guild_id)
+                )
 
     except Exception as e:
         logger.error(e)
 
 
-def create_audio_source_from_url(stream_url: str) -> Optional[PCMVolumeTransformer]:
+def handle_track_change(
+    ctx: Context, video_url: str, play_list: PlayList, messenger: MessageDispatcher
+) -> None:
+    """keeps the playlist in sync after the gapless source switched to the pre-opened track"""
+    if ctx.guild is None:
+        return
+
+    guild_id: int = ctx.guild.id
+
+    if play_list.peek_next_song(guild_id) == video_url:
+        play_list.get_next_song(guild_id)
+
+    messenger.set_now_playing(ctx, "Reproducing " + video_url)
+
+    voice_client: VoiceClient | VoiceProtocol | None = ctx.guild.voice_client
+
+    if isinstance(voice_client, VoiceClient) and isinstance(
+        voice_client.source, GaplessAudioSource
+    ):
+        spawn_background_task(
+            preload_next_song(voice_client.source, play_list, guild_id)
+        )
+
+
+def open_audio_source(video_url: str) -> Optional[PCMVolumeTransformer]:
+    local_path: str | None = local_track_path(video_url)
+
+    if local_path is not None:
+        return create_local_audio_source(local_path)
+
+    stream: YoutubeStream | None = get_youtube_stream_info(video_url)
+
+    if stream is None:
+        logger.error(f"Failed to retrieve stream URL for {video_url}")
+        return None
+
+    return create_audio_source_from_url(
+        stream["url"], video_url=video_url, duration=stream["duration"]
+    )
+
+
+def reopen_ffmpeg_source(
+    video_url: str, start_offset: float
+) -> Optional[RingBufferFFmpegAudio]:
+    """re-resolves the stream url, the old one may have expired, and seeks to the offset"""
+    stream_url: str | None = get_youtube_stream_url(video_url)
+
+    if stream_url is None:
+        logger.error(f"Failed to re-resolve stream URL for {video_url}")
+        return None
+
+    return create_ffmpeg_source(stream_url, start_offset)
+
+
+async def preload_next_song(
+    gapless_source: GaplessAudioSource, play_list: PlayList, guild_id: int
+) -> None:
+    """resolves, spawns and primes the next playlist entry off the event loop"""
+    next_video_url: str = play_list.peek_next_song(guild_id)
+
+    if next_video_url == "":
+        gapless_source.discard_next()
+        return
+
+    if next_video_url in (
+        gapless_source.next_video_url,
+        gapless_source.preparing_video_url,
+    ):
+        return
+
+    loop: AbstractEventLoop = asyncio.get_running_loop()
+    gapless_source.preparing_video_url = next_video_url
+    audio_source: PCMVolumeTransformer | None = None
+
+    try:
+        audio_source = await loop.run_in_executor(
+            None, open_audio_source, next_video_url
+        )
+
+        if audio_source is None:
+            return
+
+        await loop.run_in_executor(
+            None, gapless_source.prepare_next, next_video_url, audio_source
+        )
+    except Exception as e:
+        logger.error(f"Failed to pre-open next song: {e}")
+
+        # don't leave the spawned FFmpeg running unless it already became the next track
+        pending: PreparedTrack | None = gapless_source.pending
+        if audio_source is not None and (
+            pending is None or pending.source is not audio_source
+        ):
+            audio_source.cleanup()
+    finally:
+        gapless_source.preparing_video_url = None
+
+
+def create_ffmpeg_source(
+    stream_url: str, start_offset: float = 0.0, is_local: bool = False
+) -> Optional[RingBufferFFmpegAudio]:
     is_windows: bool = platform.system() == "Windows"
     ffmpeg_path: Literal["./ffmpeg/bin/ffmpeg.exe"] | Literal["ffmpeg"] = (
         "./ffmpeg/bin/ffmpeg.exe" if is_windows else "ffmpeg"
@@ -208,12 +414,62 @@ def create_audio_source_from_url(stream_url: str) -> Optional[PCMVolumeTransform
         logger.error(f"Could not find ffmpeg")
         return
 
+    # reconnect options only apply to network streams
+    before_options: str = (
+        "" if is_local else "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+    )
+
+    if start_offset > 0:
+        before_options += f" -ss {start_offset:.2f}"
+
+    if is_local and not exists(stream_url):
+        logger.error(f"Could not find local file {stream_url}")
+        return
+
+    # zero copy is safe here since create_audio_source_from_url wraps it in PCMVolumeTransformer
+    return RingBufferFFmpegAudio(
+        stream_url,
+        zero_copy=True,
+        executable=ffmpeg_path,
+        before_options=before_options,
+        options="-vn",
+    )
+
+
+def create_local_audio_source(file_path: str) -> Optional[PCMVolumeTransformer]:
+    """plays a file of the local library straight from disk, no url to expire so no resume"""
+    ffmpeg_source: RingBufferFFmpegAudio | None = create_ffmpeg_source(
+        file_path, is_local=True
+    )
+
+    if ffmpeg_source is None:
+        return
+
+    return PCMVolumeTransformer(ffmpeg_source, volume=1.0)
+
+
+def create_audio_source_from_url(
+    stream_url: str,
+    video_url: Optional[str] = None,
+    duration: Optional[float] = None,
+) -> Optional[PCMVolumeTransformer]:
+    """
+    Creates the FFmpeg audio source, when the YouTube url is known the source resumes
+    at the current offset if the stream fails mid-song
+    """
+    ffmpeg_source: RingBufferFFmpegAudio | None = create_ffmpeg_source(stream_url)
+
+    if ffmpeg_source is None:
+        return
+
+    if video_url is None:
+        return PCMVolumeTransformer(ffmpeg_source, volume=1.0)
+
     return PCMVolumeTransformer(
-        FFmpegPCMAudio(
-            stream_url,
-            executable=ffmpeg_path,
-            before_options="-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-            options="-vn",
+        ResumableAudioSource(
+            ffmpeg_source,
+            reopen=partial(reopen_ffmpeg_source, video_url),
+            duration=duration,
         ),
         volume=1.0,
     )
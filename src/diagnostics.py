@@ -0,0 +1,430 @@
+import asyncio
+import fnmatch
+import hmac
+import os
+import threading
+import time
+import tracemalloc
+from subprocess import Popen
+from typing import Any, Dict, List, Optional, Set, Tuple, TypedDict
+
+from aiohttp import web
+from discord import AudioSource, VoiceClient
+from discord.ext.commands import Bot
+
+from pata_logger import Logger
+from playlist import PlayList
+
+logger = Logger("diagnostics")
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# Allocation sites we care about, anything else is grouped as "other"
+ALLOCATION_AREAS: List[Tuple[str, str]] = [
+    ("bot_utils", "*bot_utils.py"),
+    ("playlist", "*playlist.py"),
+    ("title_index", "*title_index.py"),
+    ("audio_sources", "*audio_sources.py"),
+    ("discord", "*discord*"),
+    ("yt_dlp", "*yt_dlp*"),
+]
+
+# Attributes that hold the wrapped source(s) in our audio source chain
+_SOURCE_ATTRIBUTES: Tuple[str, ...] = ("original", "source", "_recovered")
+_TRACK_ATTRIBUTES: Tuple[str, ...] = ("current", "pending")
+
+
+class ProcessUsage(TypedDict):
+    pid: int
+    name: str
+    rss_bytes: int
+    cpu_seconds: float
+
+
+class GuildUsage(TypedDict):
+    guild_id: int
+    guild_name: str
+    queue_size: int
+    queue_position: int
+    voice_connected: bool
+    playing: bool
+    ffmpeg: List[ProcessUsage]
+
+
+class AllocationSite(TypedDict):
+    area: str
+    site: str
+    size_bytes: int
+    size_diff_bytes: int
+    count: int
+
+
+class TracemallocSummary(TypedDict):
+    tracing: bool
+    snapshots: List[float]
+    areas: Dict[str, int]
+    top_sites: List[AllocationSite]
+
+
+def _read_stat(pid: int) -> Tuple[str, List[str]]:
+    """returns the command name and the fields after it of /proc/<pid>/stat"""
+    with open(f"/proc/{pid}/stat", "r") as stat_file:
+        stat: str = stat_file.read()
+
+    # the command name may contain spaces, fields start after the closing parenthesis
+    name, fields = stat.split("(", 1)[1].rsplit(")", 1)
+    return name, fields.split()
+
+
+def read_process_usage(pid: int) -> Optional[ProcessUsage]:
+    """reads RSS and CPU time from /proc, None when the process is gone or /proc is missing"""
+    try:
+        with open(f"/proc/{pid}/statm", "r") as statm_file:
+            resident_pages: int = int(statm_file.read().split()[1])
+
+        name, fields = _read_stat(pid)
+
+        ticks: int = os.sysconf("SC_CLK_TCK")
+        # utime and stime are fields 14 and 15 of stat, 12 and 13 after the name
+        cpu_seconds: float = (int(fields[11]) + int(fields[12])) / ticks
+
+        return ProcessUsage(
+            pid=pid,
+            name=name,
+            rss_bytes=resident_pages * os.sysconf("SC_PAGE_SIZE"),
+            cpu_seconds=cpu_seconds,
+        )
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_rss_bytes() -> int:
+    usage: ProcessUsage | None = read_process_usage(os.getpid())
+
+    if usage is not None:
+        return usage["rss_bytes"]
+
+    if resource is None:
+        return 0
+
+    # peak instead of current RSS, ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def find_ffmpeg_processes(source: Optional[AudioSource]) -> List[Popen]:
+    """walks the wrapped audio sources (volume, resumable, gapless) down to the FFmpeg processes"""
+    processes: List[Popen] = []
+    pending: List[Any] = [source]
+    seen: set[int] = set()
+
+    while pending:
+        current: Any = pending.pop()
+
+        if current is None or id(current) in seen:
+            continue
+        seen.add(id(current))
+
+        process: Any = getattr(current, "_process", None)
+        if isinstance(process, Popen):
+            processes.append(process)
+
+        for attribute in _SOURCE_ATTRIBUTES:
+            pending.append(getattr(current, attribute, None))
+
+        for attribute in _TRACK_ATTRIBUTES:
+            track: Any = getattr(current, attribute, None)
+            pending.append(getattr(track, "source", None))
+
+    return processes
+
+
+def list_child_pids(parent_pid: Optional[int] = None) -> List[int]:
+    """pids whose parent is the bot (ppid in /proc/<pid>/stat), reachable from a source or not"""
+    parent_pid = os.getpid() if parent_pid is None else parent_pid
+    children: List[int] = []
+
+    try:
+        entries: List[str] = os.listdir("/proc")
+    except OSError:
+        return children
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+
+        try:
+            # ppid is field 4 of stat, 1 after the name
+            if int(_read_stat(int(entry))[1][1]) == parent_pid:
+                children.append(int(entry))
+        except (OSError, ValueError, IndexError):
+            # exited while scanning
+            continue
+
+    return children
+
+
+def find_unattributed_children(bot: Bot) -> List[ProcessUsage]:
+    """
+    child processes that no guild's audio source chain points to, e.g. an FFmpeg whose
+    source was dropped without cleanup(). A track being pre-opened shows up here briefly.
+    """
+    attributed: Set[int] = set()
+
+    for guild in bot.guilds:
+        voice_client: Any = guild.voice_client
+        if isinstance(voice_client, VoiceClient):
+            attributed.update(
+                process.pid for process in find_ffmpeg_processes(voice_client.source)
+            )
+
+    unattributed: List[ProcessUsage] = []
+
+    for pid in list_child_pids():
+        if pid in attributed:
+            continue
+
+        usage: ProcessUsage | None = read_process_usage(pid)
+        if usage is not None:
+            unattributed.append(usage)
+
+    return unattributed
+
+
+def collect_guild_usage(bot: Bot, play_list: PlayList) -> List[GuildUsage]:
+    usages: List[GuildUsage] = []
+
+    for guild in bot.guilds:
+        voice_client: Any = guild.voice_client
+        is_voice_client: bool = isinstance(voice_client, VoiceClient)
+
+        ffmpeg: List[ProcessUsage] = []
+        if is_voice_client:
+            for process in find_ffmpeg_processes(voice_client.source):
+                usage: ProcessUsage | None = read_process_usage(process.pid)
+                if usage is not None:
+                    ffmpeg.append(usage)
+
+        usages.append(
+            GuildUsage(
+                guild_id=guild.id,
+                guild_name=guild.name,
+                queue_size=len(play_list.play_list_dic.get(guild.id, [])),
+                queue_position=play_list.current_index_dic.get(guild.id, 0),
+                voice_connected=is_voice_client and voice_client.is_connected(),
+                playing=is_voice_client and voice_client.is_playing(),
+                ffmpeg=ffmpeg,
+            )
+        )
+
+    return usages
+
+
+def _allocation_area(filename: str) -> str:
+    for area, pattern in ALLOCATION_AREAS:
+        if fnmatch.fnmatch(filename, pattern):
+            return area
+
+    return "other"
+
+
+class TracemallocTracker:
+    """
+    Takes tracemalloc snapshots on demand and ranks allocation sites between them.
+    Snapshots and statistics walk every traced block, run them in an executor.
+    """
+
+    def __init__(self, max_snapshots: int = 5, frames: int = 1) -> None:
+        self.max_snapshots: int = max_snapshots
+        self.frames: int = frames
+        self.snapshots: List[Tuple[float, tracemalloc.Snapshot]] = []
+        # snapshots are taken and ranked from executor threads
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def is_tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            logger.info("Starting tracemalloc")
+            tracemalloc.start(self.frames)
+
+    def stop(self) -> None:
+        with self._lock:
+            self.snapshots.clear()
+
+        if tracemalloc.is_tracing():
+            logger.info("Stopping tracemalloc")
+            tracemalloc.stop()
+
+    def take_snapshot(self) -> int:
+        """returns the amount of stored snapshots, starts tracing if needed"""
+        self.start()
+
+        snapshot: tracemalloc.Snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            )
+        )
+        with self._lock:
+            self.snapshots.append((time.time(), snapshot))
+
+            if len(self.snapshots) > self.max_snapshots:
+                self.snapshots.pop(0)
+
+            return len(self.snapshots)
+
+    def top_sites(
+        self, limit: int = 10, areas: Optional[List[str]] = None
+    ) -> List[AllocationSite]:
+        """
+        ranks allocation sites of the latest snapshot, diffed against the previous one if any,
+        `areas` restricts the ranking to e.g. ["bot_utils", "playlist", "discord"]
+        """
+        with self._lock:
+            latest_snapshots: List[Tuple[float, tracemalloc.Snapshot]] = self.snapshots[-2:]
+
+        if not latest_snapshots:
+            return []
+
+        _, latest = latest_snapshots[-1]
+        sites: List[AllocationSite] = []
+
+        if len(latest_snapshots) > 1:
+            _, previous = latest_snapshots[0]
+            for stat in latest.compare_to(previous, "lineno"):
+                frame: tracemalloc.Frame = stat.traceback[0]
+                sites.append(
+                    AllocationSite(
+                        area=_allocation_area(frame.filename),
+                        site=f"{frame.filename}:{frame.lineno}",
+                        size_bytes=stat.size,
+                        size_diff_bytes=stat.size_diff,
+                        count=stat.count,
+                    )
+                )
+        else:
+            for stat in latest.statistics("lineno"):
+                frame = stat.traceback[0]
+                sites.append(
+                    AllocationSite(
+                        area=_allocation_area(frame.filename),
+                        site=f"{frame.filename}:{frame.lineno}",
+                        size_bytes=stat.size,
+                        size_diff_bytes=0,
+                        count=stat.count,
+                    )
+                )
+
+        if areas is not None:
+            sites = [site for site in sites if site["area"] in areas]
+
+        return sites[:limit]
+
+    def area_totals(self) -> Dict[str, int]:
+        """bytes of the latest snapshot grouped by bot_utils, playlist, discord..."""
+        with self._lock:
+            if not self.snapshots:
+                return dict()
+
+            _, latest = self.snapshots[-1]
+
+        totals: Dict[str, int] = dict()
+
+        for stat in latest.statistics("filename"):
+            area: str = _allocation_area(stat.traceback[0].filename)
+            totals[area] = totals.get(area, 0) + stat.size
+
+        return totals
+
+    def summarize(
+        self, limit: int = 10, areas: Optional[List[str]] = None
+    ) -> TracemallocSummary:
+        with self._lock:
+            taken_at: List[float] = [taken_at for taken_at, _ in self.snapshots]
+
+        return TracemallocSummary(
+            tracing=self.is_tracing,
+            snapshots=taken_at,
+            areas=self.area_totals(),
+            top_sites=self.top_sites(limit, areas),
+        )
+
+
+async def build_report(
+    bot: Bot,
+    play_list: PlayList,
+    tracker: TracemallocTracker,
+    areas: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    summary: TracemallocSummary = await asyncio.get_running_loop().run_in_executor(
+        None, tracker.summarize, 10, areas
+    )
+
+    return {
+        "rss_bytes": get_rss_bytes(),
+        "guilds": collect_guild_usage(bot, play_list),
+        "unattributed_processes": find_unattributed_children(bot),
+        "tracemalloc": summary,
+    }
+
+
+async def start_diagnostics_server(
+    bot: Bot,
+    play_list: PlayList,
+    tracker: TracemallocTracker,
+    token: str,
+    port: int = 8080,
+) -> web.AppRunner:
+    """
+    Serves the diagnostics report over HTTP, every request must carry the token
+    as `Authorization: Bearer <token>` since fly exposes the port publicly.
+    """
+
+    @web.middleware
+    async def require_token(request: web.Request, handler: Any) -> web.StreamResponse:
+        authorization: str = request.headers.get("Authorization", "")
+        # constant time, the port is public
+        if not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    def requested_areas(request: web.Request) -> Optional[List[str]]:
+        # e.g. /diagnostics?area=bot_utils&area=discord
+        areas: List[str] = request.query.getall("area", [])
+        return areas if areas else None
+
+    async def get_report(request: web.Request) -> web.Response:
+        return web.json_response(
+            await build_report(bot, play_list, tracker, requested_areas(request))
+        )
+
+    async def take_snapshot(request: web.Request) -> web.Response:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        snapshots: int = await loop.run_in_executor(None, tracker.take_snapshot)
+        top_sites: List[AllocationSite] = await loop.run_in_executor(
+            None, tracker.top_sites, 10, requested_areas(request)
+        )
+        return web.json_response({"snapshots": snapshots, "top_sites": top_sites})
+
+    async def stop_tracing(request: web.Request) -> web.Response:
+        tracker.stop()
+        return web.json_response({"tracing": False})
+
+    app: web.Application = web.Application(middlewares=[require_token])
+    app.router.add_get("/diagnostics", get_report)
+    app.router.add_post("/diagnostics/snapshot", take_snapshot)
+    app.router.add_post("/diagnostics/stop", stop_tracing)
+
+    runner: web.AppRunner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", port).start()
+
+    logger.info(f"Diagnostics endpoint listening on port {port}")
+
+    return runner
@@ -0,0 +1,345 @@
+import asyncio
+import json
+import platform
+import subprocess
+import threading
+from os import makedirs, path, replace, scandir, stat
+from typing import Any, Dict, List, Optional, Set, Tuple, TypedDict
+
+from pata_logger import Logger
+from title_index import TrigramMatcher
+
+logger = Logger("local_library")
+
+# Playlist entries starting with this prefix are played straight from disk
+LOCAL_TRACK_PREFIX: str = "local:"
+LIBRARY_FILE_NAME: str = "library_index.json"
+AUDIO_EXTENSIONS: Set[str] = {
+    ".mp3",
+    ".m4a",
+    ".flac",
+    ".ogg",
+    ".opus",
+    ".wav",
+    ".webm",
+    ".aac",
+}
+
+
+class LibraryTrack(TypedDict):
+    path: str
+    title: str
+    artist: str
+    album: str
+    duration: Optional[float]
+    mtime: float
+    size: int
+
+
+class ScanResult(TypedDict):
+    added: int
+    updated: int
+    removed: int
+
+
+def is_local_track(video_url: str) -> bool:
+    return video_url.startswith(LOCAL_TRACK_PREFIX)
+
+
+def local_track_path(video_url: str) -> Optional[str]:
+    """returns the file path of a local playlist entry, None for YouTube entries"""
+    if not is_local_track(video_url):
+        return None
+
+    return video_url[len(LOCAL_TRACK_PREFIX) :]
+
+
+def probe_audio_file(file_path: str) -> Dict[str, Any]:
+    """reads tags and duration with ffprobe, empty when ffprobe is missing or fails"""
+    is_windows: bool = platform.system() == "Windows"
+    ffprobe_path: str = "./ffmpeg/bin/ffprobe.exe" if is_windows else "ffprobe"
+
+    try:
+        output: bytes = subprocess.check_output(
+            [
+                ffprobe_path,
+                "-v",
+                "quiet",
+                "-print_format",
+                "json",
+                "-show_format",
+                file_path,
+            ],
+            timeout=30,
+        )
+        probe_format: Dict[str, Any] = json.loads(output).get("format", dict())
+    except (OSError, subprocess.SubprocessError, json.JSONDecodeError) as e:
+        logger.warning(f"Could not probe {file_path}: {e}")
+        return dict()
+
+    # tag names depend on the container, ID3 uses TITLE, mp4 uses title
+    tags: Dict[str, str] = {
+        key.lower(): value for key, value in probe_format.get("tags", dict()).items()
+    }
+    duration: str | None = probe_format.get("duration")
+
+    return {
+        "title": tags.get("title", ""),
+        "artist": tags.get("artist", ""),
+        "album": tags.get("album", ""),
+        "duration": float(duration) if duration else None,
+    }
+
+
+def _track_from_file(file_path: str, mtime: float, size: int) -> LibraryTrack:
+    probe: Dict[str, Any] = probe_audio_file(file_path)
+    stem: str = path.splitext(path.basename(file_path))[0]
+
+    # "Artist - Title.mp3" is the usual naming for untagged files
+    file_artist, _, file_title = stem.rpartition(" - ")
+
+    return LibraryTrack(
+        path=file_path,
+        title=probe.get("title") or file_title or stem,
+        artist=probe.get("artist") or file_artist,
+        album=probe.get("album", ""),
+        duration=probe.get("duration"),
+        mtime=mtime,
+        size=size,
+    )
+
+
+class LocalLibrary:
+    """
+    Persistent index of the audio files in the songs directory. Scans are incremental,
+    only new files or files whose mtime or size changed are probed again, and the watcher
+    only rescans directories whose mtime changed.
+    """
+
+    def __init__(
+        self, songs_dir: str = "songs", data_dir: str = "data", threshold: float = 0.7
+    ) -> None:
+        self.songs_dir: str = songs_dir
+        self.data_dir: str = data_dir
+        self.threshold: float = threshold
+
+        self.tracks: Dict[str, LibraryTrack] = dict()
+        # directory -> mtime at the time it was scanned
+        self.directories: Dict[str, float] = dict()
+        # "artist title", title and file name of every track -> track path
+        self.matcher: TrigramMatcher[str] = TrigramMatcher()
+
+        self._lock: threading.Lock = threading.Lock()
+        # the watcher and the library_scan command may scan at the same time
+        self._scan_lock: threading.Lock = threading.Lock()
+
+        makedirs(self.data_dir, exist_ok=True)
+        self.load()
+
+    @property
+    def index_path(self) -> str:
+        return path.join(self.data_dir, LIBRARY_FILE_NAME)
+
+    def __len__(self) -> int:
+        return len(self.tracks)
+
+    def _rebuild_search_index(self) -> None:
+        matcher: TrigramMatcher[str] = TrigramMatcher()
+
+        for track in self.tracks.values():
+            stem: str = path.splitext(path.basename(track["path"]))[0]
+            for text in (f"{track['artist']} {track['title']}", track["title"], stem):
+                matcher.add(track["path"], text)
+
+        self.matcher = matcher
+
+    def match(self, search_query: str) -> Optional[LibraryTrack]:
+        """returns the best matching local track above the threshold, None on a miss"""
+        with self._lock:
+            best: Tuple[str, float] | None = self.matcher.best_match(
+                search_query, self.threshold
+            )
+
+            if best is None:
+                return None
+
+            track_path, score = best
+            logger.debug(
+                f"Local library hit for query: {search_query} -> {track_path} ({score:.2f})"
+            )
+
+            return self.tracks.get(track_path)
+
+    def _scan_directory(self, directory: str, result: ScanResult) -> None:
+        """scans the files of a directory, recursing only into directories not seen before"""
+        seen_files: Set[str] = set()
+
+        try:
+            self.directories[directory] = stat(directory).st_mtime
+
+            with scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if entry.path not in self.directories:
+                            self._scan_directory(entry.path, result)
+                        continue
+
+                    if path.splitext(entry.name)[1].lower() not in AUDIO_EXTENSIONS:
+                        continue
+
+                    seen_files.add(entry.path)
+                    entry_stat = entry.stat()
+                    existing: LibraryTrack | None = self.tracks.get(entry.path)
+
+                    if (
+                        existing is not None
+                        and existing["mtime"] == entry_stat.st_mtime
+                        and existing["size"] == entry_stat.st_size
+                    ):
+                        continue
+
+                    track: LibraryTrack = _track_from_file(
+                        entry.path, entry_stat.st_mtime, entry_stat.st_size
+                    )
+
+                    with self._lock:
+                        self.tracks[entry.path] = track
+
+                    result["updated" if existing is not None else "added"] += 1
+        except OSError as e:
+            logger.error(f"Could not scan {directory}: {e}")
+            return
+
+        with self._lock:
+            for track_path in [
+                p
+                for p in self.tracks
+                if path.dirname(p) == directory and p not in seen_files
+            ]:
+                del self.tracks[track_path]
+                result["removed"] += 1
+
+    def _remove_directory(self, directory: str, result: ScanResult) -> None:
+        prefix: str = directory + path.sep
+
+        with self._lock:
+            for tracked in [
+                d for d in self.directories if d == directory or d.startswith(prefix)
+            ]:
+                del self.directories[tracked]
+
+            for track_path in [p for p in self.tracks if p.startswith(prefix)]:
+                del self.tracks[track_path]
+                result["removed"] += 1
+
+    def _finish_scan(self, result: ScanResult) -> ScanResult:
+        if result["added"] or result["updated"] or result["removed"]:
+            with self._lock:
+                self._rebuild_search_index()
+            self.save()
+
+            logger.info(f"Local library updated: {result}, {len(self)} tracks")
+
+        return result
+
+    def scan(self) -> ScanResult:
+        """incremental scan of the whole songs directory, unchanged files are not probed again"""
+        with self._scan_lock:
+            return self._scan()
+
+    def _scan(self) -> ScanResult:
+        result: ScanResult = ScanResult(added=0, updated=0, removed=0)
+
+        if not path.isdir(self.songs_dir):
+            logger.warning(f"Songs directory {self.songs_dir} does not exist")
+            self._remove_directory(self.songs_dir, result)
+            return self._finish_scan(result)
+
+        for directory in list(self.directories):
+            if not path.isdir(directory):
+                self._remove_directory(directory, result)
+
+        # rescan every known directory, new ones are picked up while recursing
+        known_directories: List[str] = [
+            d for d in self.directories if d != self.songs_dir
+        ]
+        self._scan_directory(self.songs_dir, result)
+
+        for directory in known_directories:
+            self._scan_directory(directory, result)
+
+        return self._finish_scan(result)
+
+    def refresh_changed(self) -> ScanResult:
+        """rescans only the directories whose mtime changed since the last scan"""
+        with self._scan_lock:
+            return self._refresh_changed()
+
+    def _refresh_changed(self) -> ScanResult:
+        result: ScanResult = ScanResult(added=0, updated=0, removed=0)
+
+        for directory, mtime in list(self.directories.items()):
+            if directory not in self.directories:
+                # removed along with its parent
+                continue
+
+            try:
+                current_mtime: float = stat(directory).st_mtime
+            except OSError:
+                self._remove_directory(directory, result)
+                continue
+
+            if current_mtime != mtime:
+                self._scan_directory(directory, result)
+
+        if not self.directories and path.isdir(self.songs_dir):
+            self._scan_directory(self.songs_dir, result)
+
+        return self._finish_scan(result)
+
+    async def watch(self, interval: float = 30.0) -> None:
+        """polls the directories mtimes and rescans the changed ones off the event loop"""
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+        await loop.run_in_executor(None, self.scan)
+
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.refresh_changed)
+            except Exception as e:
+                logger.error(f"Local library refresh failed: {e}")
+
+    def save(self) -> None:
+        with self._lock:
+            library: Dict[str, Any] = {
+                "tracks": list(self.tracks.values()),
+                "directories": dict(self.directories),
+            }
+
+        temp_path: str = self.index_path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as library_file:
+                json.dump(library, library_file)
+            replace(temp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"Could not save local library index: {e}")
+
+    def load(self) -> None:
+        if not path.exists(self.index_path):
+            return
+
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as library_file:
+                library: Dict[str, Any] = json.load(library_file)
+
+            self.tracks = {track["path"]: track for track in library["tracks"]}
+            self.directories = library["directories"]
+        except (OSError, KeyError, json.JSONDecodeError) as e:
+            logger.error(f"Corrupt local library index, it will be rescanned: {e}")
+            self.tracks = dict()
+            self.directories = dict()
+
+        self._rebuild_search_index()
+
+        logger.info(f"Loaded local library with {len(self)} tracks")
@@ -0,0 +1,212 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional, Tuple, TypedDict
+
+from discord import Color, Embed, HTTPException, Message, NotFound
+from discord.ext.commands import Context
+
+from embed_builder import EmbedBuilder
+from pata_logger import Logger
+
+logger = Logger("message_dispatcher")
+
+
+def _error_embed(title: str, description: str) -> Embed:
+    return (
+        EmbedBuilder()
+        .set_title(title)
+        .set_description(description)
+        .set_color(Color.red())
+        .build()
+    )
+
+
+# Static error embeds, built once and reused on every send
+MISSING_QUERY_EMBED: Embed = _error_embed("Play", "Please provided at least 1 argument")
+USER_NOT_IN_CHANNEL_EMBED: Embed = _error_embed(
+    "Play", "User is not in a channel, failed to join..."
+)
+NO_AUDIO_SOURCE_EMBED: Embed = _error_embed("Play", "Could not obtain audio source")
+NO_STREAM_URL_EMBED: Embed = _error_embed("Play", "Failed to retrieve stream URL.")
+EMPTY_PLAYLIST_EMBED: Embed = _error_embed(
+    "Playlist", "No songs in playlist, please add at least one"
+)
+PAUSE_NOT_CONNECTED_EMBED: Embed = _error_embed(
+    "Pause Song", "Bot is not connected in a voice channel"
+)
+PAUSE_NOT_PLAYING_EMBED: Embed = _error_embed(
+    "Pause Song", "Bot is not reproducing, can't pause"
+)
+RESUME_NOT_CONNECTED_EMBED: Embed = _error_embed(
+    "Resume Song", "Bot is not in a channel, can't resume"
+)
+RESUME_ALREADY_PLAYING_EMBED: Embed = _error_embed(
+    "Resume Song", "Bot is already reproducing a song"
+)
+
+
+class MessageStats(TypedDict):
+    sent: int
+    edited: int
+    merged: int
+    dropped: int
+
+
+class GuildStatus:
+    def __init__(self, ctx: Context) -> None:
+        self.ctx: Context = ctx
+        self.now_playing: str = ""
+        self.last_event: str = ""
+        self.message: Optional[Message] = None
+        self.rendered: Optional[Dict[str, Any]] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        # set on every update, cleared when a flush renders the current state
+        self.dirty: bool = False
+        self.flushing: bool = False
+
+    def build(self) -> Embed:
+        lines: list[str] = [line for line in (self.now_playing, self.last_event) if line]
+        return (
+            EmbedBuilder()
+            .set_title("Now Playing" if self.now_playing else "Pata Song's")
+            .set_description("\n".join(lines))
+            .build()
+        )
+
+
+class MessageDispatcher:
+    """
+    Coalesces the bot's outbound messages to stay away from Discord's per channel rate limits.
+    Every guild gets a single status message that is edited in place, rapid updates are debounced
+    into one REST call and repeated errors in the same channel are dropped.
+    """
+
+    def __init__(self, debounce_seconds: float = 0.75) -> None:
+        self.debounce_seconds: float = debounce_seconds
+        self.statuses: Dict[int, GuildStatus] = dict()
+        # (channel id, id of the static embed) -> last time it was sent
+        self.recent_errors: Dict[Tuple[int, int], float] = dict()
+        self.stats: MessageStats = MessageStats(sent=0, edited=0, merged=0, dropped=0)
+
+    def _get_status(self, ctx: Context) -> Optional[GuildStatus]:
+        if ctx.guild is None:
+            logger.error("Could not obtain guild")
+            return None
+
+        status: GuildStatus | None = self.statuses.get(ctx.guild.id)
+
+        if status is None:
+            status = GuildStatus(ctx)
+            self.statuses[ctx.guild.id] = status
+        else:
+            # always answer in the channel of the latest command
+            status.ctx = ctx
+
+        return status
+
+    def _schedule(self, status: GuildStatus) -> None:
+        # an update is merged only when it replaces one that has not been rendered yet,
+        # updates arriving while a send is in flight mark the status dirty again instead
+        if status.dirty:
+            self.stats["merged"] += 1
+
+        status.dirty = True
+
+        if status.flush_task is None or status.flush_task.done():
+            status.flush_task = asyncio.create_task(self._debounced_flush(status))
+
+    def set_now_playing(self, ctx: Context, text: str) -> None:
+        status: GuildStatus | None = self._get_status(ctx)
+        if status is None:
+            return
+
+        status.now_playing = text
+        status.last_event = ""
+        self._schedule(status)
+
+    def set_event(self, ctx: Context, text: str) -> None:
+        status: GuildStatus | None = self._get_status(ctx)
+        if status is None:
+            return
+
+        status.last_event = text
+        self._schedule(status)
+
+    async def _debounced_flush(self, status: GuildStatus) -> None:
+        # keeps flushing while updates arrived during the previous send or edit
+        while status.dirty:
+            await asyncio.sleep(self.debounce_seconds)
+
+            status.dirty = False
+            status.flushing = True
+            try:
+                await self._flush(status)
+            finally:
+                status.flushing = False
+
+    async def _flush(self, status: GuildStatus) -> None:
+        embed: Embed = status.build()
+        rendered: Dict[str, Any] = embed.to_dict()
+
+        if rendered == status.rendered:
+            self.stats["dropped"] += 1
+            return
+
+        try:
+            if (
+                status.message is not None
+                and status.message.channel.id == status.ctx.channel.id
+            ):
+                try:
+                    await status.message.edit(embed=embed)
+                    self.stats["edited"] += 1
+                    status.rendered = rendered
+                    return
+                except NotFound:
+                    logger.debug("Status message was deleted, sending a new one")
+
+            status.message = await status.ctx.send(embed=embed)
+            self.stats["sent"] += 1
+            status.rendered = rendered
+        except HTTPException as e:
+            logger.error(f"Could not send status message: {e}")
+
+    async def close(self, guild_id: int) -> None:
+        """flushes any pending update and forgets the status message of the guild"""
+        status: GuildStatus | None = self.statuses.pop(guild_id, None)
+
+        if status is None:
+            return
+
+        if status.flush_task is None or status.flush_task.done():
+            return
+
+        if status.flushing:
+            # let the in flight send finish, it re-flushes anything that arrived meanwhile
+            await status.flush_task
+            return
+
+        status.flush_task.cancel()
+        if status.dirty:
+            status.dirty = False
+            await self._flush(status)
+
+    async def send_error(self, ctx: Context, embed: Embed) -> None:
+        """sends a (static) error embed, dropping repeats in the same channel within the debounce window"""
+        key: Tuple[int, int] = (ctx.channel.id, id(embed))
+        now: float = time.monotonic()
+
+        if now - self.recent_errors.get(key, float("-inf")) < self.debounce_seconds:
+            self.stats["dropped"] += 1
+            return
+
+        self.recent_errors[key] = now
+
+        try:
+            await ctx.send(embed=embed)
+            self.stats["sent"] += 1
+        except HTTPException as e:
+            logger.error(f"Could not send error message: {e}")
+
+    def get_stats(self) -> MessageStats:
+        return MessageStats(**self.stats)
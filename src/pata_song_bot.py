@@ -1,15 +1,41 @@
+import asyncio
 from typing import Any, Literal
 from youtube_result import YoutubeResult
 from playlist import PlayList
+from title_index import TitleIndex
+from local_library import LocalLibrary, ScanResult, is_local_track
 from discord.ext import commands
 from discord.ext.commands import Bot, Context
 from dotenv import load_dotenv
 from discord.utils import get
-from discord import Color, Embed, Guild, Intents, VoiceProtocol, VoiceClient
+from discord import Embed, Guild, Intents, VoiceProtocol, VoiceClient
 from os import getenv
 from pata_logger import Logger
 import bot_utils
+import diagnostics
+from diagnostics import (
+    GuildUsage,
+    ProcessUsage,
+    TracemallocSummary,
+    TracemallocTracker,
+)
+from audio_sources import (
+    GaplessAudioSource,
+    audio_buffer_totals,
+    playback_recovery_totals,
+)
 from embed_builder import EmbedBuilder
+from message_dispatcher import (
+    EMPTY_PLAYLIST_EMBED,
+    MISSING_QUERY_EMBED,
+    PAUSE_NOT_CONNECTED_EMBED,
+    PAUSE_NOT_PLAYING_EMBED,
+    RESUME_ALREADY_PLAYING_EMBED,
+    RESUME_NOT_CONNECTED_EMBED,
+    USER_NOT_IN_CHANNEL_EMBED,
+    MessageDispatcher,
+    MessageStats,
+)
 
 load_dotenv()
 
@@ -25,10 +51,53 @@ BOT_COMMAND_PREFIX :str | None = getenv("BOT_COMMAND_PREFIX")
 if BOT_COMMAND_PREFIX is None:
     raise RuntimeError("Could not obtain bot command prefix from environment settings")
 
+DIAGNOSTICS_TOKEN: str | None = getenv("DIAGNOSTICS_TOKEN")
+DIAGNOSTICS_PORT: int = int(getenv("DIAGNOSTICS_PORT", "8080"))
+
+# queries are matched against the songs directory before YouTube only when enabled
+LOCAL_LIBRARY_ENABLED: bool = getenv("LOCAL_LIBRARY_ENABLED", "false").lower() == "true"
+SONGS_DIR: str = getenv("SONGS_DIR", "songs")
+LIBRARY_MATCH_THRESHOLD: float = float(getenv("LIBRARY_MATCH_THRESHOLD", "0.7"))
+LIBRARY_WATCH_INTERVAL: float = float(getenv("LIBRARY_WATCH_INTERVAL", "30"))
+
+TITLE_INDEX_DIR: str = getenv("TITLE_INDEX_DIR", "data")
+TITLE_INDEX_THRESHOLD: float = float(getenv("TITLE_INDEX_THRESHOLD", "0.6"))
+TITLE_INDEX_CROSS_GUILD: bool = getenv("TITLE_INDEX_CROSS_GUILD", "false").lower() == "true"
+
 bot = Bot(command_prefix=BOT_COMMAND_PREFIX, intents=intents)
 play_list = PlayList()
+messenger = MessageDispatcher()
+title_index = TitleIndex(
+    data_dir=TITLE_INDEX_DIR,
+    threshold=TITLE_INDEX_THRESHOLD,
+    cross_guild=TITLE_INDEX_CROSS_GUILD,
+)
+local_library: LocalLibrary | None = (
+    LocalLibrary(
+        songs_dir=SONGS_DIR, data_dir=TITLE_INDEX_DIR, threshold=LIBRARY_MATCH_THRESHOLD
+    )
+    if LOCAL_LIBRARY_ENABLED
+    else None
+)
+tracemalloc_tracker = TracemallocTracker()
 logger = Logger("pata_song_bot")
 
+
+@bot.event
+async def setup_hook():
+    if local_library is not None:
+        bot_utils.spawn_background_task(local_library.watch(LIBRARY_WATCH_INTERVAL))
+
+    # without a token the endpoint stays off, fly exposes the port publicly
+    if DIAGNOSTICS_TOKEN is None:
+        logger.info("DIAGNOSTICS_TOKEN not set, diagnostics endpoint disabled")
+        return
+
+    await diagnostics.start_diagnostics_server(
+        bot, play_list, tracemalloc_tracker, DIAGNOSTICS_TOKEN, DIAGNOSTICS_PORT
+    )
+
+
 @bot.command()
 async def reproduce_playlist(ctx: Context):
     if ctx.guild is None:
@@ -38,27 +107,31 @@ async def reproduce_playlist(ctx: Context):
     guild_id: int = ctx.guild.id
 
     if play_list.get_playlist_lenght(guild_id) == 0:
-        await ctx.send("No songs in playlist, please add at least one")
+        await messenger.send_error(ctx, EMPTY_PLAYLIST_EMBED)
         return
 
     audio_name: Any | Literal[""] = play_list.get_next_song(guild_id)
 
     if audio_name == "":
-        await ctx.send("Play list end")
+        messenger.set_event(ctx, "Play list end")
         play_list.reset_play_list(guild_id)
         return
 
     connected_to_channel: bool = await bot_utils.connect_to_voice_channel(ctx)
     if connected_to_channel:
         # connect bot to channel
-        await ctx.send("Bot connected to channel!")
+        messenger.set_event(ctx, "Bot connected to channel!")
 
         # Reproduce Music
         await bot_utils.reproduce_song(
-            ctx=ctx, video_url=audio_name, bot=bot, play_list=play_list
+            ctx=ctx,
+            video_url=audio_name,
+            bot=bot,
+            play_list=play_list,
+            messenger=messenger,
         )
     else:
-        await ctx.send("User is not in a channel, failed to join...")
+        await messenger.send_error(ctx, USER_NOT_IN_CHANNEL_EMBED)
 
 
 @bot.command()
@@ -81,7 +154,7 @@ async def add_playlist(
     Behavior
     --------
     - Validates that a query was provided.
-    - Searches YouTube using the query.
+    - Matches the query against the local music library and the title index, searching YouTube only on a miss.
     - If a result is found, extracts the video URL suffix.
     - Adds the song to the playlist associated with the current server (`guild.id`).
     - Sends a confirmation message to the Discord text channel.
@@ -101,16 +174,7 @@ async def add_playlist(
     youtube_query: str = args
 
     if youtube_query == "":
-        await ctx.send("Please provided at least 1 argument")
-        return
-
-    youtube_search_result: YoutubeResult | None = bot_utils.search_youtube(
-        youtube_query
-    )
-
-    if youtube_search_result is None:
-        logger.error(f"No video result obtained, returning.")
-        await ctx.send(f"Could not find anything related to: {youtube_query}")
+        await messenger.send_error(ctx, MISSING_QUERY_EMBED)
         return
 
     if ctx.guild is None:
@@ -119,9 +183,20 @@ async def add_playlist(
 
     guild_id: int = ctx.guild.id
 
+    youtube_search_result: YoutubeResult | None = bot_utils.resolve_query(
+        youtube_query, guild_id, title_index, local_library
+    )
+
+    if youtube_search_result is None:
+        logger.error(f"No video result obtained, returning.")
+        messenger.set_event(ctx, f"Could not find anything related to: {youtube_query}")
+        return
+
     play_list.add_to_playlist(guild_id, youtube_search_result["url_suffix"])
 
-    await ctx.send("Song " + youtube_search_result["title"] + " added to playlist!")
+    messenger.set_event(
+        ctx, "Song " + youtube_search_result["title"] + " added to playlist!"
+    )
 
 
 @bot.command()
@@ -144,7 +219,7 @@ async def play(
     Behavior
     --------
     - Validates that a query was provided.
-    - Searches YouTube using the query.
+    - Matches the query against the local music library and the title index, searching YouTube only on a miss.
     - If a result is found, extracts the video URL suffix.
     - Adds the song to the playlist associated with the current server (`guild.id`).
     - Sends a confirmation message to the Discord text channel.
@@ -165,16 +240,20 @@ async def play(
         youtube_query: str = args
 
         if youtube_query == "":
-            await ctx.send("Please provided at least 1 argument")
+            await messenger.send_error(ctx, MISSING_QUERY_EMBED)
+            return
+
+        if ctx.guild is None:
+            logger.error(f"Could not obtain guild")
             return
 
-        youtube_search_result: YoutubeResult | None = bot_utils.search_youtube(
-            youtube_query
+        youtube_search_result: YoutubeResult | None = bot_utils.resolve_query(
+            youtube_query, ctx.guild.id, title_index, local_library
         )
 
         if youtube_search_result is None:
             logger.error(f"No video result obtained, returning.")
-            await ctx.send(f"Could not find anything related to: {youtube_query}")
+            messenger.set_event(ctx, f"Could not find anything related to: {youtube_query}")
             return
 
         message: str = (
@@ -182,9 +261,11 @@ async def play(
             + youtube_search_result["title"]
             + " downloading song..."
         )
-        await ctx.send(message)
+        messenger.set_event(ctx, message)
 
-        if "list" in youtube_search_result["url_suffix"]:
+        if "list" in youtube_search_result["url_suffix"] and not is_local_track(
+            youtube_search_result["url_suffix"]
+        ):
             youtube_search_result["url_suffix"] = youtube_search_result[
                 "url_suffix"
             ].split("&")[0]
@@ -198,9 +279,10 @@ async def play(
                 video_url=youtube_search_result["url_suffix"],
                 bot=bot,
                 play_list=play_list,
+                messenger=messenger,
             )
         else:
-            await ctx.send("User is not in a channel, failed to join...")
+            await messenger.send_error(ctx, USER_NOT_IN_CHANNEL_EMBED)
     except AttributeError as e:
         logger.error(e)
         return
@@ -223,22 +305,186 @@ async def next_song(ctx: Context):
             logger.error(f"Could not obtain instance of VoiceClient")
             return
 
+        # the next song is already pre-opened, switch to it without stopping the player
+        if (
+            isinstance(voice_client.source, GaplessAudioSource)
+            and voice_client.source.skip()
+        ):
+            return
+
         new_audio_name: Any | Literal[""] = play_list.get_next_song(guild_id)
 
         if new_audio_name == "":
-            await ctx.send("No more songs in playlist, going to clear playlist!")
+            messenger.set_event(
+                ctx, "No more songs in playlist, going to clear playlist!"
+            )
             play_list.reset_play_list(guild_id)
             return
 
         if voice_client.is_playing():
             voice_client.stop()
 
-        await bot_utils.reproduce_song(ctx, new_audio_name, bot, play_list)
+        await bot_utils.reproduce_song(
+            ctx, new_audio_name, bot, play_list, messenger
+        )
     except AttributeError as e:
         logger.error(e)
         return
 
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def library_scan(ctx: Context):
+    """Scans the songs directory for new, changed or removed files."""
+    if local_library is None:
+        await ctx.send("Local library is disabled, set LOCAL_LIBRARY_ENABLED=true")
+        return
+
+    result: ScanResult = await asyncio.get_running_loop().run_in_executor(
+        None, local_library.scan
+    )
+
+    embed: Embed = (
+        EmbedBuilder()
+        .set_title("Local Library")
+        .set_description(
+            f"{len(local_library)} tracks, {result['added']} added, "
+            f"{result['updated']} updated, {result['removed']} removed"
+        )
+        .build()
+    )
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def rebuild_index(ctx: Context):
+    """Rebuilds the local title index from the resolved songs history."""
+    titles: int = await asyncio.get_running_loop().run_in_executor(
+        None, title_index.rebuild_from_history
+    )
+
+    embed: Embed = (
+        EmbedBuilder()
+        .set_title("Title Index")
+        .set_description(f"Index rebuilt with {titles} titles")
+        .build()
+    )
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+async def message_stats(ctx: Context):
+    """Shows how many outbound messages were sent, edited, merged or dropped."""
+    stats: MessageStats = messenger.get_stats()
+
+    embed: Embed = (
+        EmbedBuilder()
+        .set_title("Message Stats")
+        .set_description(
+            f"Sent: {stats['sent']}\n"
+            f"Edited: {stats['edited']}\n"
+            f"Merged: {stats['merged']}\n"
+            f"Dropped: {stats['dropped']}"
+        )
+        .build()
+    )
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+async def audio_stats(ctx: Context):
+    """Shows the ring buffer and stream recovery metrics of every finished track."""
+    average_recovery_ms: float = playback_recovery_totals["total_latency_ms"] / max(
+        playback_recovery_totals["resumes"], 1
+    )
+
+    embed: Embed = (
+        EmbedBuilder()
+        .set_title("Audio Stats")
+        .set_description(
+            f"Frames: {audio_buffer_totals['frames']}\n"
+            f"Underruns: {audio_buffer_totals['underruns']}\n"
+            f"Full buffer waits: {audio_buffer_totals['full_waits']}\n"
+            f"Resumes: {playback_recovery_totals['resumes']}\n"
+            f"Failed resumes: {playback_recovery_totals['failures']}\n"
+            f"Average recovery: {average_recovery_ms:.0f}ms"
+        )
+        .build()
+    )
+    await ctx.send(embed=embed)
+
+
+@bot.command(name="diagnostics")
+# the report spans every guild and tracing is process wide, a server admin isn't enough
+@commands.is_owner()
+async def diagnostics_command(
+    ctx: Context,
+    action: str = commands.parameter(
+        default="", description="snapshot, stop or empty for the report"
+    ),
+):
+    """
+    Reports memory and per guild resource usage, `snapshot` takes a tracemalloc snapshot
+    and ranks allocation sites against the previous one, `stop` stops tracing.
+    """
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+
+    if action == "snapshot":
+        await loop.run_in_executor(None, tracemalloc_tracker.take_snapshot)
+    elif action == "stop":
+        tracemalloc_tracker.stop()
+
+    lines: list[str] = [f"RSS: {diagnostics.get_rss_bytes() / 1024 / 1024:.1f} MB"]
+
+    usage: GuildUsage
+    for usage in diagnostics.collect_guild_usage(bot, play_list):
+        ffmpeg: str = ", ".join(
+            f"pid {process['pid']} {process['rss_bytes'] / 1024 / 1024:.1f} MB "
+            f"{process['cpu_seconds']:.1f}s cpu"
+            for process in usage["ffmpeg"]
+        )
+        lines.append(
+            f"**{usage['guild_name']}** queue {usage['queue_position']}/{usage['queue_size']}"
+            f" voice: {'playing' if usage['playing'] else 'connected' if usage['voice_connected'] else 'no'}"
+            + (f" ffmpeg: {ffmpeg}" if ffmpeg else "")
+        )
+
+    unattributed: list[ProcessUsage] = diagnostics.find_unattributed_children(bot)
+    if unattributed:
+        lines.append("**Child processes not attached to any guild**")
+        for process in unattributed:
+            lines.append(
+                f"pid {process['pid']} {process['name']} "
+                f"{process['rss_bytes'] / 1024 / 1024:.1f} MB {process['cpu_seconds']:.1f}s cpu"
+            )
+
+    summary: TracemallocSummary = await loop.run_in_executor(
+        None, tracemalloc_tracker.summarize, 5
+    )
+
+    if summary["snapshots"]:
+        lines.append("**Allocations by area**")
+        for area, size in sorted(summary["areas"].items(), key=lambda item: -item[1]):
+            lines.append(f"{area}: {size / 1024:.0f} KB")
+
+        lines.append("**Top allocation sites**")
+        for site in summary["top_sites"]:
+            lines.append(
+                f"{site['area']} `{site['site'].rsplit('/', 1)[-1]}` "
+                f"{site['size_bytes'] / 1024:.0f} KB ({site['size_diff_bytes'] / 1024:+.0f} KB)"
+            )
+
+    embed: Embed = (
+        EmbedBuilder()
+        .set_title("Diagnostics")
+        # embed descriptions are capped at 4096 characters
+        .set_description("\n".join(lines)[:4096])
+        .build()
+    )
+    await ctx.send(embed=embed)
+
+
 @bot.command()
 async def leave(ctx: Context):
     try:
@@ -259,6 +505,7 @@ async def leave(ctx: Context):
             logger.debug("Client is playing songs, stopping")
             voice_client.stop()
 
+        await messenger.close(guild.id)
         await voice_client.disconnect()
     except AttributeError as e:
         logger.error(e)
@@ -274,16 +521,14 @@ async def pause(ctx: Context):
         voice_client: VoiceClient | VoiceProtocol | None = get(bot.voice_clients, guild = guild)
 
         if not isinstance(voice_client, VoiceClient):            
-            embed:Embed= EmbedBuilder().set_title("Pause Song").set_description("Bot is not connected in a voice channel").set_color(Color.red()).build()
-            await ctx.send(embed=embed)
+            await messenger.send_error(ctx, PAUSE_NOT_CONNECTED_EMBED)
             return
 
         if voice_client.is_paused():
             return
 
         if not voice_client.is_playing():
-            embed:Embed= EmbedBuilder().set_title("Pause Song").set_description("Bot is not reproducing, can\'t pause").set_color(Color.red()).build()
-            await ctx.send(embed=embed)            
+            await messenger.send_error(ctx, PAUSE_NOT_PLAYING_EMBED)
             return    
         
         voice_client.pause()
@@ -301,13 +546,11 @@ async def resume(ctx: Context):
         voice_client: VoiceClient | VoiceProtocol | None = get(bot.voice_clients, guild = guild)
 
         if not isinstance(voice_client, VoiceClient):    
-            embed:Embed= EmbedBuilder().set_title("Resume Song").set_description("Bot is not in a channel, can\'t resume").set_color(Color.red()).build()        
-            await ctx.send(embed= embed)
+            await messenger.send_error(ctx, RESUME_NOT_CONNECTED_EMBED)
             return
 
         if voice_client.is_playing():
-            embed:Embed= EmbedBuilder().set_title("Resume Song").set_description("Bot is already reproducing a song").set_color(Color.red()).build()
-            await ctx.send(embed=embed)            
+            await messenger.send_error(ctx, RESUME_ALREADY_PLAYING_EMBED)
             return                    
         
         voice_client.resume()
@@ -27,6 +27,16 @@ class PlayList:
 
         return song_name
 
+    def peek_next_song(self, connection_id):
+        # Same as get_next_song but without moving the current index
+        playlist = self.play_list_dic.get(connection_id, [])
+        current_idx = self.current_index_dic.get(connection_id, 0)
+
+        if len(playlist) <= current_idx:
+            return ""
+
+        return playlist[current_idx]
+
     def reset_play_list(self, connection_id):
         self.play_list_dic[connection_id] = []
         self.current_index_dic[connection_id] = 0
@@ -0,0 +1,272 @@
+import subprocess
+import sys
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from discord import AudioSource
+
+from audio_sources import (
+    FRAME_SIZE,
+    SILENCE_FRAME,
+    GaplessAudioSource,
+    ResumableAudioSource,
+    RingBufferFFmpegAudio,
+    playback_recovery_totals,
+)
+
+
+class FakeSource(AudioSource):
+    def __init__(self, frames: list[bytes]) -> None:
+        self.frames: list[bytes] = list(frames)
+        self.cleaned_up: bool = False
+
+    def read(self) -> bytes:
+        return self.frames.pop(0) if self.frames else b""
+
+    def cleanup(self) -> None:
+        self.cleaned_up = True
+
+
+def test_gapless_switches_to_next_track_inside_read():
+    changes: list[str] = []
+    current = FakeSource([b"a1", b"a2"])
+    next_source = FakeSource([b"b1", b"b2"])
+    gapless = GaplessAudioSource(
+        current, "a", peek_next=lambda: "b", on_track_change=changes.append
+    )
+
+    assert gapless.prepare_next("b", next_source)
+    frames = [gapless.read() for _ in range(5)]
+
+    assert frames == [b"a1", b"a2", b"b1", b"b2", b""]
+    assert changes == ["b"]
+    assert current.cleaned_up
+
+
+def test_gapless_drops_next_track_when_queue_changed():
+    next_up: list[str] = ["b"]
+    next_source = FakeSource([b"b1"])
+    gapless = GaplessAudioSource(
+        FakeSource([b"a1"]), "a", peek_next=lambda: next_up[0]
+    )
+
+    gapless.prepare_next("b", next_source)
+    next_up[0] = "c"
+
+    assert gapless.read() == b"a1"
+    assert gapless.read() == b""
+    assert next_source.cleaned_up
+
+
+def test_gapless_skip_and_cleanup():
+    gapless = GaplessAudioSource(
+        FakeSource([b"a1", b"a2"]), "a", peek_next=lambda: "b"
+    )
+    assert not gapless.skip()
+
+    gapless.prepare_next("b", FakeSource([b"b1"]))
+    assert gapless.skip()
+    assert gapless.read() == b"b1"
+
+    unused = FakeSource([b"c1"])
+    gapless.peek_next = lambda: "c"
+    gapless.prepare_next("c", unused)
+    gapless.cleanup()
+
+    assert unused.cleaned_up
+    assert not gapless.prepare_next("d", FakeSource([b"d1"]))
+
+
+class StalledSource(AudioSource):
+    """blocks in read() until cleaned up, like FFmpeg waiting on a dead stream"""
+
+    def __init__(self) -> None:
+        self.cleaned_up = threading.Event()
+
+    def read(self) -> bytes:
+        self.cleaned_up.wait()
+        return b""
+
+    def cleanup(self) -> None:
+        self.cleaned_up.set()
+
+
+def test_gapless_gives_up_priming_a_stalled_track():
+    stalled = StalledSource()
+    gapless = GaplessAudioSource(FakeSource([b"a1"]), "a", peek_next=lambda: "b")
+
+    with patch("audio_sources.PRIME_TIMEOUT_SECONDS", 0.05):
+        assert not gapless.prepare_next("b", stalled)
+
+    assert stalled.cleaned_up.is_set()
+    assert gapless.next_video_url is None
+
+
+def spawn_fake_ffmpeg(frames: int, delay: float = 0.0) -> subprocess.Popen:
+    """stands in for FFmpeg, writes `frames` PCM frames to stdout"""
+    script: str = (
+        "import sys, time\n"
+        f"for i in range({frames}):\n"
+        f"    sys.stdout.buffer.write(bytes([i % 255 + 1]) * {FRAME_SIZE})\n"
+        "    sys.stdout.buffer.flush()\n"
+        f"    time.sleep({delay})\n"
+    )
+    return subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE)
+
+
+def test_ring_buffer_reads_every_frame_then_eof():
+    with patch.object(
+        RingBufferFFmpegAudio, "_spawn_process", return_value=spawn_fake_ffmpeg(40)
+    ):
+        source = RingBufferFFmpegAudio("https://audio.test", buffer_frames=8, jitter_frames=4)
+
+    frames: list[bytes] = []
+    frame: bytes = source.read()
+    while frame:
+        if frame != SILENCE_FRAME:
+            frames.append(frame)
+        frame = source.read()
+    source.cleanup()
+
+    assert all(len(frame) == FRAME_SIZE for frame in frames)
+    assert [frame[0] for frame in frames] == [i + 1 for i in range(40)]
+    assert source.stats["frames"] == 40
+
+
+def test_ring_buffer_zero_copy_hands_out_memoryviews():
+    with patch.object(
+        RingBufferFFmpegAudio, "_spawn_process", return_value=spawn_fake_ffmpeg(3)
+    ):
+        source = RingBufferFFmpegAudio(
+            "https://audio.test", buffer_frames=4, jitter_frames=3, zero_copy=True
+        )
+
+    frame = source.read()
+
+    assert isinstance(frame, memoryview)
+    assert bytes(frame) == bytes([1]) * FRAME_SIZE
+    assert bytes(source.read()) == bytes([2]) * FRAME_SIZE
+    source.cleanup()
+
+
+def test_ring_buffer_underrun_plays_silence():
+    with patch.object(
+        RingBufferFFmpegAudio,
+        "_spawn_process",
+        return_value=spawn_fake_ffmpeg(3, delay=0.5),
+    ):
+        source = RingBufferFFmpegAudio("https://audio.test", buffer_frames=4, jitter_frames=1)
+
+    assert source.read() == bytes([1]) * FRAME_SIZE
+    assert source.read() == SILENCE_FRAME
+    assert source.stats["underruns"] == 1
+    source.cleanup()
+
+
+def test_ring_buffer_producer_waits_for_a_slow_player():
+    with patch.object(
+        RingBufferFFmpegAudio, "_spawn_process", return_value=spawn_fake_ffmpeg(10)
+    ):
+        source = RingBufferFFmpegAudio("https://audio.test", buffer_frames=4, jitter_frames=3)
+
+    frames: list[bytes] = []
+    frame: bytes = source.read()
+    while frame:
+        if frame != SILENCE_FRAME:
+            frames.append(frame)
+        # slower than FFmpeg, the ring fills up and the reader thread has to wait
+        time.sleep(0.01)
+        frame = source.read()
+    source.cleanup()
+
+    # waiting is back-pressure, no frame is ever dropped
+    assert [frame[0] for frame in frames] == [i + 1 for i in range(10)]
+    assert source.stats["full_waits"] > 0
+    assert source.returncode == 0
+
+
+def spawn_failing_ffmpeg() -> subprocess.Popen:
+    """stands in for FFmpeg losing its input, one frame then a non-zero exit"""
+    script: str = f"import sys\nsys.stdout.buffer.write(bytes({FRAME_SIZE}))\nsys.exit(1)\n"
+    return subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE)
+
+
+def test_ring_buffer_records_ffmpeg_failure():
+    with patch.object(
+        RingBufferFFmpegAudio, "_spawn_process", return_value=spawn_failing_ffmpeg()
+    ):
+        source = RingBufferFFmpegAudio("https://audio.test", buffer_frames=4, jitter_frames=1)
+
+    while source.read():
+        pass
+    source.cleanup()
+
+    assert source.returncode == 1
+    assert source.failed
+
+
+def read_past_silence(source: AudioSource, attempts: int = 200) -> bytes:
+    frame: bytes = source.read()
+    while frame == SILENCE_FRAME and attempts > 0:
+        time.sleep(0.01)
+        frame = source.read()
+        attempts -= 1
+    return frame
+
+
+def test_resumable_reopens_at_offset_after_early_eof():
+    offsets: list[float] = []
+
+    def reopen(offset: float) -> AudioSource:
+        offsets.append(offset)
+        return FakeSource([b"b1", b"b2"])
+
+    resumes_before: int = playback_recovery_totals["resumes"]
+    source = ResumableAudioSource(FakeSource([b"a1", b"a2"]), reopen, duration=60)
+
+    assert source.read() == b"a1"
+    assert source.read() == b"a2"
+    assert source.read() == SILENCE_FRAME
+    assert read_past_silence(source) == b"b1"
+    assert source.read() == b"b2"
+
+    assert offsets == [pytest.approx(0.04)]
+    assert source.resumes == 1
+    assert source.elapsed == pytest.approx(0.08)
+    assert playback_recovery_totals["resumes"] == resumes_before + 1
+
+
+def test_resumable_reopens_after_ffmpeg_failure_without_duration():
+    with patch.object(
+        RingBufferFFmpegAudio, "_spawn_process", return_value=spawn_failing_ffmpeg()
+    ):
+        failing = RingBufferFFmpegAudio("https://audio.test", buffer_frames=4, jitter_frames=1)
+
+    reopen = MagicMock(return_value=FakeSource([b"b1"]))
+    source = ResumableAudioSource(failing, reopen)
+
+    # the failing stream's only frame is silent as well
+    assert read_past_silence(source) == b"b1"
+    reopen.assert_called_once()
+    source.cleanup()
+
+
+def test_resumable_ends_normally_at_end_of_track():
+    reopen = MagicMock()
+    source = ResumableAudioSource(FakeSource([b"a1"]), reopen, duration=1)
+
+    assert source.read() == b"a1"
+    assert source.read() == b""
+    reopen.assert_not_called()
+
+
+def test_resumable_gives_up_when_reopen_fails():
+    failures_before: int = playback_recovery_totals["failures"]
+    source = ResumableAudioSource(FakeSource([]), lambda offset: None, duration=60)
+
+    assert read_past_silence(source) == b""
+    assert source.read() == b""
+    assert playback_recovery_totals["failures"] == failures_before + 1
@@ -1,10 +1,17 @@
-from unittest.mock import patch
+import asyncio
+from unittest.mock import MagicMock, patch
 
 import pytest
+from audio_sources import GaplessAudioSource
 from bot_utils import (
+    background_tasks,
     create_audio_source_from_url,
+    create_ffmpeg_source,
+    get_youtube_stream_info,
     get_youtube_stream_url,
+    preload_next_song,
     search_youtube,
+    spawn_background_task,
 )
 from pata_logger import Logger
 from youtube_result import YoutubeResult
@@ -36,6 +43,20 @@ def test_search_youtube_no_results(mock_ytdl):
     assert result is None
 
 
+def test_background_tasks_are_kept_until_done():
+    async def run():
+        task = spawn_background_task(asyncio.sleep(0.01))
+        assert task in background_tasks
+        await task
+        # the done callback runs on the next loop iteration
+        await asyncio.sleep(0)
+        return task
+
+    task = asyncio.run(run())
+
+    assert task not in background_tasks
+
+
 @patch("bot_utils.YoutubeDL")
 def test_get_youtube_stream_url_success(mock_ytdl):
     mock_ytdl.return_value.__enter__.return_value.extract_info.return_value = {
@@ -54,6 +75,20 @@ def test_get_youtube_stream_url_success(mock_ytdl):
     assert url == "https://audio.test"
 
 
+@patch("bot_utils.YoutubeDL")
+def test_get_youtube_stream_info_duration(mock_ytdl):
+    mock_ytdl.return_value.__enter__.return_value.extract_info.return_value = {
+        "duration": 255,
+        "formats": [{"abr": 128, "url": "https://audio.test"}],
+    }
+
+    stream = get_youtube_stream_info("https://youtu.be/test")
+
+    assert stream is not None
+    assert stream["url"] == "https://audio.test"
+    assert stream["duration"] == 255
+
+
 @patch("bot_utils.YoutubeDL")
 def test_get_youtube_stream_url_no_audio_formats(mock_ytdl):
     mock_ytdl.return_value.__enter__.return_value.extract_info.return_value = {
@@ -73,6 +108,15 @@ def test_create_audio_source_from_url_success(mock_system, mock_exists):
     assert result is not None
 
 
+@patch("bot_utils.RingBufferFFmpegAudio")
+@patch("bot_utils.platform.system", return_value="Linux")
+def test_create_ffmpeg_source_seeks_to_offset(mock_system, mock_ring_buffer):
+    create_ffmpeg_source("https://audio.test", start_offset=42.5)
+
+    before_options: str = mock_ring_buffer.call_args.kwargs["before_options"]
+    assert before_options.endswith("-ss 42.50")
+
+
 @patch("bot_utils.exists", return_value=False)
 @patch("bot_utils.platform.system", return_value="Windows")
 def test_create_audio_source_from_url_missing_ffmpeg(mock_system, mock_exists):
@@ -96,3 +140,21 @@ def test_get_youtube_stream_url_real():
 
     assert stream_url is not None
     assert stream_url.startswith("http")
+
+
+@patch("bot_utils.open_audio_source")
+def test_preload_cleans_up_the_source_when_priming_fails(mock_open_audio_source):
+    audio_source = MagicMock()
+    mock_open_audio_source.return_value = audio_source
+    gapless_source = MagicMock(spec=GaplessAudioSource)
+    gapless_source.next_video_url = None
+    gapless_source.preparing_video_url = None
+    gapless_source.pending = None
+    gapless_source.prepare_next.side_effect = RuntimeError("stalled")
+    play_list = MagicMock()
+    play_list.peek_next_song.return_value = "https://www.youtube.com/watch?v=next"
+
+    asyncio.run(preload_next_song(gapless_source, play_list, 1))
+
+    audio_source.cleanup.assert_called_once()
+    assert gapless_source.preparing_video_url is None
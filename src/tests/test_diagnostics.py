@@ -0,0 +1,147 @@
+import asyncio
+import os
+import subprocess
+import sys
+from unittest.mock import MagicMock
+
+import aiohttp
+
+from discord import AudioSource, PCMVolumeTransformer, VoiceClient
+
+from audio_sources import GaplessAudioSource
+from diagnostics import (
+    TracemallocTracker,
+    build_report,
+    find_ffmpeg_processes,
+    find_unattributed_children,
+    get_rss_bytes,
+    list_child_pids,
+    read_process_usage,
+    start_diagnostics_server,
+)
+from playlist import PlayList
+
+
+class FakeFFmpegSource(AudioSource):
+    def __init__(self, process: subprocess.Popen) -> None:
+        self._process: subprocess.Popen = process
+
+    def read(self) -> bytes:
+        return bytes(4)
+
+
+def test_read_process_usage_of_current_process():
+    usage = read_process_usage(os.getpid())
+
+    assert usage is not None
+    assert usage["rss_bytes"] > 0
+    assert usage["cpu_seconds"] >= 0
+    assert get_rss_bytes() > 0
+
+
+def test_read_process_usage_of_missing_process():
+    assert read_process_usage(-1) is None
+
+
+def test_find_ffmpeg_processes_walks_the_source_chain():
+    current_process = subprocess.Popen([sys.executable, "-c", "pass"])
+    pending_process = subprocess.Popen([sys.executable, "-c", "pass"])
+    gapless = GaplessAudioSource(
+        PCMVolumeTransformer(FakeFFmpegSource(current_process)),
+        "a",
+        peek_next=lambda: "b",
+    )
+    gapless.prepare_next("b", FakeFFmpegSource(pending_process))
+
+    processes = find_ffmpeg_processes(gapless)
+
+    assert set(processes) == {current_process, pending_process}
+    current_process.wait()
+    pending_process.wait()
+
+
+def test_unattributed_children_are_reported():
+    attached = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+    leaked = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(5)"])
+    voice_client = MagicMock(spec=VoiceClient)
+    voice_client.source = PCMVolumeTransformer(FakeFFmpegSource(attached))
+    bot = MagicMock()
+    bot.guilds = [MagicMock(voice_client=voice_client)]
+
+    try:
+        assert {attached.pid, leaked.pid} <= set(list_child_pids())
+        unattributed = {usage["pid"] for usage in find_unattributed_children(bot)}
+    finally:
+        attached.kill()
+        leaked.kill()
+        attached.wait()
+        leaked.wait()
+
+    assert leaked.pid in unattributed
+    assert attached.pid not in unattributed
+
+
+def test_tracker_ranks_sites_between_snapshots():
+    tracker = TracemallocTracker()
+    tracker.take_snapshot()
+    allocated = [bytearray(1024) for _ in range(200)]
+    tracker.take_snapshot()
+
+    sites = tracker.top_sites(limit=3)
+
+    assert len(allocated) == 200
+    assert sites[0]["site"].startswith(__file__)
+    assert sites[0]["size_diff_bytes"] >= 200 * 1024
+    assert tracker.top_sites(areas=["playlist"]) == []
+    assert sum(tracker.area_totals().values()) > 0
+
+    tracker.stop()
+    assert not tracker.is_tracing
+    assert tracker.top_sites() == []
+
+
+def test_report_ranks_allocations_in_an_executor():
+    tracker = TracemallocTracker()
+    tracker.start()
+    allocated = [bytearray(1024) for _ in range(200)]
+    tracker.take_snapshot()
+    bot = MagicMock()
+    bot.guilds = []
+
+    report = asyncio.run(build_report(bot, PlayList(), tracker))
+
+    assert report["tracemalloc"]["tracing"]
+    assert len(report["tracemalloc"]["snapshots"]) == 1
+    assert len(allocated) == 200
+    assert report["tracemalloc"]["top_sites"]
+    tracker.stop()
+
+
+def test_diagnostics_endpoint_requires_the_token():
+    async def run():
+        bot = MagicMock()
+        bot.guilds = []
+        runner = await start_diagnostics_server(
+            bot, PlayList(), TracemallocTracker(), "secret", port=0
+        )
+        port = runner.addresses[0][1]
+        url = f"http://127.0.0.1:{port}/diagnostics"
+
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(url) as missing:
+                    missing_status = missing.status
+                async with session.get(
+                    url, headers={"Authorization": "Bearer wrong"}
+                ) as wrong:
+                    wrong_status = wrong.status
+                async with session.get(
+                    url, headers={"Authorization": "Bearer secret"}
+                ) as valid:
+                    valid_status = valid.status
+        finally:
+            await runner.cleanup()
+
+        return missing_status, wrong_status, valid_status
+
+    assert asyncio.run(run()) == (401, 401, 200)
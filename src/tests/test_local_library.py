@@ -0,0 +1,95 @@
+import os
+from unittest.mock import patch
+
+from bot_utils import resolve_query
+from local_library import LOCAL_TRACK_PREFIX, LocalLibrary, local_track_path
+from title_index import TitleIndex
+
+PROBE_RESULT = {"title": "", "artist": "", "album": "", "duration": 255.0}
+
+
+def create_song(directory, name: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    file_path: str = os.path.join(directory, name)
+    with open(file_path, "wb") as song_file:
+        song_file.write(b"not really audio")
+    return file_path
+
+
+@patch("local_library.probe_audio_file", return_value=PROBE_RESULT)
+def test_scan_is_incremental(mock_probe, tmp_path):
+    songs_dir = str(tmp_path / "songs")
+    create_song(songs_dir, "Alice In Chains - Rooster.mp3")
+    create_song(os.path.join(songs_dir, "live"), "Alice In Chains - Would.flac")
+    create_song(songs_dir, "cover.jpg")
+
+    library = LocalLibrary(songs_dir=songs_dir, data_dir=str(tmp_path / "data"))
+    result = library.scan()
+
+    assert result == {"added": 2, "updated": 0, "removed": 0}
+    assert mock_probe.call_count == 2
+
+    # nothing changed, nothing probed again
+    assert library.scan() == {"added": 0, "updated": 0, "removed": 0}
+    assert mock_probe.call_count == 2
+
+
+@patch("local_library.probe_audio_file", return_value=PROBE_RESULT)
+def test_match_and_persistence(mock_probe, tmp_path):
+    songs_dir = str(tmp_path / "songs")
+    song_path = create_song(songs_dir, "Alice In Chains - Rooster.mp3")
+
+    library = LocalLibrary(songs_dir=songs_dir, data_dir=str(tmp_path / "data"))
+    library.scan()
+
+    track = library.match("rooster alice in chains")
+    assert track is not None
+    assert track["path"] == song_path
+    assert track["artist"] == "Alice In Chains"
+    assert track["duration"] == 255.0
+    assert library.match("never going to give you up") is None
+    # every query word must be in the track, a live version isn't this file
+    assert library.match("rooster live") is None
+
+    reloaded = LocalLibrary(songs_dir=songs_dir, data_dir=str(tmp_path / "data"))
+    assert reloaded.match("Rooster") is not None
+
+
+@patch("local_library.probe_audio_file", return_value=PROBE_RESULT)
+def test_refresh_changed_only_rescans_changed_directories(mock_probe, tmp_path):
+    songs_dir = str(tmp_path / "songs")
+    create_song(songs_dir, "Alice In Chains - Rooster.mp3")
+    live_song = create_song(os.path.join(songs_dir, "live"), "Alice In Chains - Would.flac")
+
+    library = LocalLibrary(songs_dir=songs_dir, data_dir=str(tmp_path / "data"))
+    library.scan()
+
+    assert library.refresh_changed() == {"added": 0, "updated": 0, "removed": 0}
+
+    os.remove(live_song)
+    create_song(songs_dir, "Alice In Chains - Man In The Box.mp3")
+    # directory mtimes may have a coarse resolution, force them to look changed
+    for directory in library.directories:
+        library.directories[directory] -= 10
+
+    assert library.refresh_changed() == {"added": 1, "updated": 0, "removed": 1}
+    assert library.match("man in the box") is not None
+    assert library.match("would") is None
+
+
+@patch("bot_utils.search_youtube")
+@patch("local_library.probe_audio_file", return_value=PROBE_RESULT)
+def test_resolve_query_prefers_local_library(mock_probe, mock_search, tmp_path):
+    songs_dir = str(tmp_path / "songs")
+    song_path = create_song(songs_dir, "Alice In Chains - Rooster.mp3")
+    library = LocalLibrary(songs_dir=songs_dir, data_dir=str(tmp_path / "data"))
+    library.scan()
+
+    result = resolve_query(
+        "rooster alice in chains", 1, TitleIndex(data_dir=str(tmp_path / "data")), library
+    )
+
+    assert result is not None
+    assert result["url_suffix"] == LOCAL_TRACK_PREFIX + song_path
+    assert local_track_path(result["url_suffix"]) == song_path
+    mock_search.assert_not_called()
@@ -0,0 +1,100 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+from message_dispatcher import MISSING_QUERY_EMBED, MessageDispatcher
+
+
+def create_context() -> MagicMock:
+    ctx = MagicMock()
+    ctx.guild.id = 1
+    ctx.channel.id = 10
+    message = MagicMock()
+    message.channel.id = 10
+    message.edit = AsyncMock()
+    ctx.send = AsyncMock(return_value=message)
+    return ctx
+
+
+def test_rapid_updates_are_merged_into_one_send():
+    async def run():
+        messenger = MessageDispatcher(debounce_seconds=0.01)
+        ctx = create_context()
+
+        messenger.set_event(ctx, "Matched result for query: rooster")
+        messenger.set_event(ctx, "Bot connected to channel!")
+        messenger.set_now_playing(ctx, "Reproducing rooster")
+        await asyncio.sleep(0.05)
+
+        return messenger, ctx
+
+    messenger, ctx = asyncio.run(run())
+
+    ctx.send.assert_awaited_once()
+    assert messenger.get_stats()["merged"] == 2
+    assert messenger.get_stats()["sent"] == 1
+
+
+def test_status_message_is_edited_in_place():
+    async def run():
+        messenger = MessageDispatcher(debounce_seconds=0.01)
+        ctx = create_context()
+
+        messenger.set_now_playing(ctx, "Reproducing rooster")
+        await asyncio.sleep(0.05)
+        messenger.set_event(ctx, "Added to playlist:  man in the box")
+        await asyncio.sleep(0.05)
+        # nothing changed, no REST call at all
+        messenger.set_event(ctx, "Added to playlist:  man in the box")
+        await asyncio.sleep(0.05)
+
+        return messenger, ctx
+
+    messenger, ctx = asyncio.run(run())
+
+    ctx.send.assert_awaited_once()
+    ctx.send.return_value.edit.assert_awaited_once()
+    assert messenger.get_stats()["dropped"] == 1
+
+
+def test_repeated_errors_are_dropped():
+    async def run():
+        messenger = MessageDispatcher(debounce_seconds=10)
+        ctx = create_context()
+
+        await messenger.send_error(ctx, MISSING_QUERY_EMBED)
+        await messenger.send_error(ctx, MISSING_QUERY_EMBED)
+
+        return messenger, ctx
+
+    messenger, ctx = asyncio.run(run())
+
+    ctx.send.assert_awaited_once_with(embed=MISSING_QUERY_EMBED)
+    assert messenger.get_stats()["dropped"] == 1
+
+
+def test_updates_during_a_slow_send_are_rendered():
+    async def run():
+        messenger = MessageDispatcher(debounce_seconds=0.01)
+        ctx = create_context()
+        message = ctx.send.return_value
+
+        async def slow_send(embed):
+            await asyncio.sleep(0.05)
+            return message
+
+        ctx.send.side_effect = slow_send
+
+        messenger.set_now_playing(ctx, "Reproducing rooster")
+        await asyncio.sleep(0.02)
+        # the send is in flight, this update must not be lost
+        messenger.set_event(ctx, "Added to playlist:  man in the box")
+        await asyncio.sleep(0.1)
+
+        return messenger, ctx
+
+    messenger, ctx = asyncio.run(run())
+
+    ctx.send.assert_awaited_once()
+    embed = ctx.send.return_value.edit.await_args.kwargs["embed"]
+    assert "man in the box" in embed.description
+    assert messenger.get_stats()["merged"] == 0
@@ -0,0 +1,105 @@
+from unittest.mock import patch
+
+from bot_utils import resolve_query
+from title_index import TitleIndex, normalize_text
+from youtube_result import YoutubeResult
+
+ROOSTER: YoutubeResult = YoutubeResult(
+    title="Alice In Chains - Rooster (2022 Remaster)",
+    url_suffix="https://www.youtube.com/watch?v=ZUqBglpHTO0",
+)
+
+
+def test_normalize_text():
+    assert normalize_text("Rooster (2022 Remaster)") == "rooster 2022 remaster"
+    assert normalize_text("  Canción   Ñandú ") == "cancion nandu"
+
+
+def test_match_near_variant(tmp_path):
+    title_index = TitleIndex(data_dir=str(tmp_path))
+    title_index.record(1, "rooster alice in chains", ROOSTER)
+
+    index_match = title_index.match("Rooster Alice in Chains", 1)
+
+    assert index_match is not None
+    assert index_match["result"]["url_suffix"] == ROOSTER["url_suffix"]
+    assert title_index.match("never going to give you up", 1) is None
+
+
+def test_match_guild_scope(tmp_path):
+    title_index = TitleIndex(data_dir=str(tmp_path))
+    title_index.record(1, "rooster alice in chains", ROOSTER)
+
+    assert title_index.match("rooster alice in chains", 2) is None
+
+    title_index.cross_guild = True
+    assert title_index.match("rooster alice in chains", 2) is not None
+
+
+def test_index_persists_and_rebuilds(tmp_path):
+    title_index = TitleIndex(data_dir=str(tmp_path), snapshot_every=1)
+    title_index.record(1, "rooster alice in chains", ROOSTER)
+    title_index.record(1, "rooster 2022 remaster", ROOSTER)
+
+    reloaded = TitleIndex(data_dir=str(tmp_path))
+    assert len(reloaded) == 1
+    assert reloaded.match("rooster 2022 remaster", 1) is not None
+
+    assert reloaded.rebuild_from_history() == 1
+    assert reloaded.match("rooster alice in chains", 1) is not None
+
+
+@patch("bot_utils.search_youtube", return_value=ROOSTER)
+def test_resolve_query_only_searches_on_miss(mock_search, tmp_path):
+    title_index = TitleIndex(data_dir=str(tmp_path))
+
+    assert resolve_query("rooster alice in chains", 1, title_index) == ROOSTER
+    assert resolve_query("rooster alice in chains", 1, title_index) == ROOSTER
+
+    mock_search.assert_called_once()
+
+
+def test_query_with_extra_words_misses(tmp_path):
+    title_index = TitleIndex(data_dir=str(tmp_path))
+    title_index.record(1, "rooster", ROOSTER)
+
+    assert title_index.match("rooster live", 1) is None
+    assert title_index.match("Alice in Chains Rooster (2022 Remaster)", 1) is not None
+
+
+def test_query_missing_words_of_the_indexed_text_misses(tmp_path):
+    title_index = TitleIndex(data_dir=str(tmp_path))
+    title_index.record(
+        1,
+        "rooster live",
+        YoutubeResult(
+            title="Alice In Chains - Rooster (Live)",
+            url_suffix="https://www.youtube.com/watch?v=live",
+        ),
+    )
+
+    assert title_index.match("rooster", 1) is None
+    assert title_index.match("alice in chains", 1) is None
+    assert title_index.match("Rooster (Live)", 1) is not None
+
+
+def test_match_tolerates_typos(tmp_path):
+    title_index = TitleIndex(data_dir=str(tmp_path))
+    title_index.record(1, "rooster alice in chains", ROOSTER)
+    title_index.record(1, "rooster remaster", ROOSTER)
+
+    assert title_index.match("roster alice in chains", 1) is not None
+    assert title_index.match("Rooster Remastered", 1) is not None
+
+
+@patch("bot_utils.search_youtube", return_value=ROOSTER)
+def test_resolve_query_does_not_record_fuzzy_hits(mock_search, tmp_path):
+    title_index = TitleIndex(data_dir=str(tmp_path))
+    title_index.record(1, "rooster alice in chains", ROOSTER)
+
+    assert resolve_query("alice in chains roster", 1, title_index) == ROOSTER
+
+    mock_search.assert_not_called()
+    with open(title_index.history_path, "r", encoding="utf-8") as history_file:
+        # only the exact record, the typo isn't stored as an alias
+        assert len(history_file.readlines()) == 1
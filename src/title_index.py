@@ -0,0 +1,395 @@
+import json
+import re
+import threading
+import unicodedata
+from os import makedirs, path, replace
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    TypeVar,
+)
+
+from pata_logger import Logger
+from youtube_result import YoutubeResult
+
+logger = Logger("title_index")
+
+HISTORY_FILE_NAME: str = "title_history.jsonl"
+SNAPSHOT_FILE_NAME: str = "title_index.json"
+
+# Trigram similarity for a query word to count as an indexed word, "roster" ~ "rooster" is 0.8
+WORD_SIMILARITY: float = 0.5
+# Share of the indexed text's letters the query may leave unmatched, e.g. a year or "remaster"
+MAX_UNMATCHED_SHARE: float = 0.25
+
+
+class TitleIndexRecord(TypedDict):
+    guild_id: int
+    query: str
+    title: str
+    url_suffix: str
+
+
+class TitleIndexMatch(TypedDict):
+    result: YoutubeResult
+    score: float
+
+
+def normalize_text(text: str) -> str:
+    """lowercases, strips accents and punctuation so 'Rooster (2022 Remaster)' == 'rooster 2022 remaster'"""
+    decomposed: str = unicodedata.normalize("NFKD", text)
+    without_accents: str = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", without_accents.lower()).split())
+
+
+def _token_trigrams(token: str) -> Set[str]:
+    padded: str = f"  {token} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def trigrams(text: str) -> Set[str]:
+    """pg_trgm style trigrams, every token is padded so short words still produce grams"""
+    grams: Set[str] = set()
+
+    for token in normalize_text(text).split():
+        grams |= _token_trigrams(token)
+
+    return grams
+
+
+def _dice(first: Set[str], second: Set[str]) -> float:
+    return 2 * len(first & second) / (len(first) + len(second))
+
+
+K = TypeVar("K")
+
+
+Word = Tuple[str, Set[str]]
+
+
+def _words(text: str) -> List[Word]:
+    return [(token, _token_trigrams(token)) for token in normalize_text(text).split()]
+
+
+def _covers(query_words: List[Word], doc_words: List[Word]) -> bool:
+    """
+    every query word must be similar to an indexed word, so "roster" still finds "rooster"
+    but "rooster live" never resolves to "rooster", and the indexed words left unmatched
+    must be minor, so neither "rooster" nor "alice in chains" resolve to "rooster live"
+    """
+    matched: Set[int] = set()
+
+    for query_token, query_grams in query_words:
+        best: Optional[Tuple[float, int]] = None
+
+        for i, (doc_token, doc_grams) in enumerate(doc_words):
+            similarity: float = (
+                1.0 if doc_token == query_token else _dice(query_grams, doc_grams)
+            )
+            if best is None or similarity > best[0]:
+                best = (similarity, i)
+
+        if best is None or best[0] < WORD_SIMILARITY:
+            return False
+
+        matched.add(best[1])
+
+    total_letters: int = sum(len(token) for token, _ in doc_words)
+    unmatched_letters: int = sum(
+        len(token) for i, (token, _) in enumerate(doc_words) if i not in matched
+    )
+
+    return unmatched_letters <= MAX_UNMATCHED_SHARE * total_letters
+
+
+class TrigramMatcher(Generic[K]):
+    """
+    Inverted trigram index over short texts, every text points to a key. Candidates must
+    cover each other word by word (see _covers), the Dice coefficient then ranks them.
+    """
+
+    def __init__(self) -> None:
+        # doc id -> (key, indexed words, trigram count)
+        self.documents: List[Tuple[K, List[Word], int]] = []
+        self.postings: Dict[str, Set[int]] = dict()
+
+    def add(self, key: K, text: str) -> None:
+        grams: Set[str] = trigrams(text)
+
+        if not grams:
+            return
+
+        doc_id: int = len(self.documents)
+        self.documents.append((key, _words(text), len(grams)))
+
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(doc_id)
+
+    def best_match(
+        self,
+        search_query: str,
+        threshold: float,
+        accept: Optional[Callable[[K], bool]] = None,
+    ) -> Optional[Tuple[K, float]]:
+        """returns the best key and its score above the threshold, None on a miss"""
+        query_grams: Set[str] = trigrams(search_query)
+        query_words: List[Word] = _words(search_query)
+
+        if not query_grams:
+            return None
+
+        overlaps: Dict[int, int] = dict()
+        for gram in query_grams:
+            for doc_id in self.postings.get(gram, ()):
+                overlaps[doc_id] = overlaps.get(doc_id, 0) + 1
+
+        best: Optional[Tuple[float, int]] = None
+
+        for doc_id, overlap in overlaps.items():
+            key, doc_words, doc_gram_count = self.documents[doc_id]
+
+            # Dice coefficient between the query and the indexed text
+            score: float = 2 * overlap / (len(query_grams) + doc_gram_count)
+
+            if score < threshold or (best is not None and score <= best[0]):
+                continue
+
+            if accept is not None and not accept(key):
+                continue
+
+            if not _covers(query_words, doc_words):
+                continue
+
+            best = (score, doc_id)
+
+        if best is None:
+            return None
+
+        return self.documents[best[1]][0], best[0]
+
+
+class _IndexedTitles:
+    """In memory part of the title index, a rebuild fills a new one and swaps it in whole"""
+
+    def __init__(self) -> None:
+        # (guild_id, url_suffix) -> title
+        self.titles: Dict[Tuple[int, str], str] = dict()
+        self.matcher: TrigramMatcher[Tuple[int, str]] = TrigramMatcher()
+        # (guild_id, url_suffix, normalized text) of every text already in the matcher
+        self.indexed_texts: Set[Tuple[int, str, str]] = set()
+
+    def index_text(self, guild_id: int, url_suffix: str, text: str) -> None:
+        normalized: str = normalize_text(text)
+        key: Tuple[int, str, str] = (guild_id, url_suffix, normalized)
+
+        if normalized == "" or key in self.indexed_texts:
+            return
+
+        self.matcher.add((guild_id, url_suffix), normalized)
+        self.indexed_texts.add(key)
+
+    def apply(self, record: TitleIndexRecord) -> None:
+        guild_id: int = record["guild_id"]
+        url_suffix: str = record["url_suffix"]
+
+        self.titles[(guild_id, url_suffix)] = record["title"]
+        self.index_text(guild_id, url_suffix, record["title"])
+        self.index_text(guild_id, url_suffix, record["query"])
+
+
+class TitleIndex:
+    """
+    In memory trigram inverted index of every title (and the queries that resolved to it),
+    backed by an append only history file and a periodic snapshot on disk.
+    """
+
+    def __init__(
+        self,
+        data_dir: str = "data",
+        threshold: float = 0.6,
+        cross_guild: bool = False,
+        snapshot_every: int = 20,
+    ) -> None:
+        self.data_dir: str = data_dir
+        self.threshold: float = threshold
+        self.cross_guild: bool = cross_guild
+        self.snapshot_every: int = snapshot_every
+
+        self.indexed: _IndexedTitles = _IndexedTitles()
+
+        self.history_lines: int = 0
+        self.pending_snapshot: int = 0
+        # rebuild_index saves from an executor while record() may save from the event loop
+        self._save_lock: threading.Lock = threading.Lock()
+
+        makedirs(self.data_dir, exist_ok=True)
+        self.load()
+
+    @property
+    def history_path(self) -> str:
+        return path.join(self.data_dir, HISTORY_FILE_NAME)
+
+    @property
+    def snapshot_path(self) -> str:
+        return path.join(self.data_dir, SNAPSHOT_FILE_NAME)
+
+    def __len__(self) -> int:
+        return len(self.indexed.titles)
+
+    def clear(self) -> None:
+        self.indexed = _IndexedTitles()
+
+    def match(self, search_query: str, guild_id: int) -> Optional[TitleIndexMatch]:
+        """returns the best indexed result above the confidence threshold, None on a miss"""
+        # a rebuild may swap the index meanwhile, stick to the one the match came from
+        indexed: _IndexedTitles = self.indexed
+        best: Tuple[Tuple[int, str], float] | None = indexed.matcher.best_match(
+            search_query,
+            self.threshold,
+            accept=lambda key: self.cross_guild or key[0] == guild_id,
+        )
+
+        if best is None:
+            logger.debug(f"Index miss for query: {search_query}")
+            return None
+
+        (doc_guild_id, url_suffix), score = best
+        title: str = indexed.titles[(doc_guild_id, url_suffix)]
+
+        logger.debug(f"Index hit for query: {search_query} -> {title} ({score:.2f})")
+
+        return TitleIndexMatch(
+            result=YoutubeResult(title=title, url_suffix=url_suffix), score=score
+        )
+
+    def record(self, guild_id: int, search_query: str, result: YoutubeResult) -> None:
+        """adds a resolved query to the index and appends it to the history file"""
+        record: TitleIndexRecord = TitleIndexRecord(
+            guild_id=guild_id,
+            query=search_query,
+            title=result["title"],
+            url_suffix=result["url_suffix"],
+        )
+
+        self.indexed.apply(record)
+
+        try:
+            with open(self.history_path, "a", encoding="utf-8") as history_file:
+                history_file.write(json.dumps(record) + "\n")
+            self.history_lines += 1
+        except OSError as e:
+            logger.error(f"Could not append to title history: {e}")
+            return
+
+        self.pending_snapshot += 1
+        if self.pending_snapshot >= self.snapshot_every:
+            self.save()
+
+    def _read_history(self, skip: int = 0) -> Tuple[List[TitleIndexRecord], int]:
+        """returns the records after the first `skip` lines and the total amount of lines"""
+        records: List[TitleIndexRecord] = []
+        line_count: int = 0
+
+        if not path.exists(self.history_path):
+            return records, line_count
+
+        with open(self.history_path, "r", encoding="utf-8") as history_file:
+            for line_number, line in enumerate(history_file):
+                line_count += 1
+                if line_number < skip or line.strip() == "":
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping corrupt title history line {line_number}")
+
+        return records, line_count
+
+    def save(self) -> None:
+        indexed: _IndexedTitles = self.indexed
+        # copied at once, record() may add entries from the event loop while this one runs
+        titles: List[Tuple[Tuple[int, str], str]] = list(indexed.titles.items())
+        indexed_texts: List[Tuple[int, str, str]] = list(indexed.indexed_texts)
+
+        snapshot: Dict[str, Any] = {
+            "history_lines": self.history_lines,
+            "titles": [
+                {"guild_id": guild_id, "url_suffix": url_suffix, "title": title}
+                for (guild_id, url_suffix), title in titles
+            ],
+            "documents": [
+                {"guild_id": guild_id, "url_suffix": url_suffix, "text": text}
+                for guild_id, url_suffix, text in indexed_texts
+            ],
+        }
+
+        temp_path: str = self.snapshot_path + ".tmp"
+        try:
+            with self._save_lock:
+                with open(temp_path, "w", encoding="utf-8") as snapshot_file:
+                    json.dump(snapshot, snapshot_file)
+                # replace is atomic, a crash never leaves half a snapshot behind
+                replace(temp_path, self.snapshot_path)
+            self.pending_snapshot = 0
+            logger.debug(f"Saved title index snapshot with {len(titles)} titles")
+        except OSError as e:
+            logger.error(f"Could not save title index snapshot: {e}")
+
+    def load(self) -> None:
+        """loads the last snapshot and replays the history written after it"""
+        self.clear()
+        self.history_lines = 0
+        indexed: _IndexedTitles = self.indexed
+
+        if path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "r", encoding="utf-8") as snapshot_file:
+                    snapshot: Dict[str, Any] = json.load(snapshot_file)
+
+                for title in snapshot["titles"]:
+                    indexed.titles[(title["guild_id"], title["url_suffix"])] = title["title"]
+                for document in snapshot["documents"]:
+                    indexed.index_text(
+                        document["guild_id"], document["url_suffix"], document["text"]
+                    )
+                self.history_lines = snapshot["history_lines"]
+            except (OSError, KeyError, json.JSONDecodeError) as e:
+                logger.error(f"Corrupt title index snapshot, rebuilding from history: {e}")
+                self.rebuild_from_history()
+                return
+
+        replayed, line_count = self._read_history(skip=self.history_lines)
+        for record in replayed:
+            indexed.apply(record)
+
+        self.history_lines = max(self.history_lines, line_count)
+        self.pending_snapshot = len(replayed)
+
+        logger.info(f"Loaded title index with {len(self)} titles")
+
+    def rebuild_from_history(self) -> int:
+        """
+        replays the full history into a new in memory index and swaps it in, returns the
+        amount of titles. Matches keep using the old index meanwhile, so it can run in an
+        executor, a record() racing with it is only lost in memory until the next load.
+        """
+        records, line_count = self._read_history()
+
+        indexed: _IndexedTitles = _IndexedTitles()
+        for record in records:
+            indexed.apply(record)
+
+        self.indexed = indexed
+        self.history_lines = line_count
+        self.save()
+
+        logger.info(f"Rebuilt title index with {len(self)} titles from {len(records)} records")
+
+        return len(self)
@@ -1,6 +1,11 @@
-from typing import TypedDict
+from typing import Optional, TypedDict
 
 
 class YoutubeResult(TypedDict):
     title: str
     url_suffix: str
+
+
+class YoutubeStream(TypedDict):
+    url: str
+    duration: Optional[float]